@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+"""
+Seeded generator of synthetic source trees for benchmarking jprep.
+
+Each kind of corpus stresses a different part of the preprocessor:
+  minified     a few bundles that are each a single enormous line
+  nested       deeply nested scopes with directives at every level
+  directives   files that are mostly directives
+  templates    template literals, nested and spanning lines
+  dead         huge branches that the configuration discards
+  tree         thousands of small files, in directories of 50
+The same seed and scale always produce the same files.
+"""
+
+import argparse
+import os
+import random
+
+KINDS = ['minified', 'nested', 'directives', 'templates', 'dead', 'tree']
+
+CONFIG = (
+    '/*$define PLATFORM = web < web, node, electron*/\n'
+    '/*$define BUILD = release < debug, release*/\n'
+    '/*$define LOGGING*/\n'
+    )
+
+NAMES = ['PLATFORM', 'BUILD', 'LOGGING', 'local', 'feature']
+VALUES = {'PLATFORM': ['web', 'node', 'electron'], 'BUILD': ['debug', 'release']}
+
+def statement(r):
+    """A line of ordinary looking code"""
+    return r.choice([
+        'const x = compute(a, b) + "string with { and /*$note*/";',
+        "let s = 'it\\'s' + other;",
+        'for (let i = 0; i < n; i++) { total += values[i]; }',
+        'if (ready) { start(); } else { wait(); }',
+        'return `value ${x} of ${y}`;',
+        '// a comment with a { brace',
+        '/* a block comment */ call();',
+        'object.method({ key: value, other: [1, 2, 3] });',
+        '',
+        ])
+
+def condition(r):
+    name = r.choice(NAMES[:3])
+    if name in VALUES:
+        return f'{name} = {r.choice(VALUES[name])}'
+    return name
+
+def if_block(r, body):
+    """Wraps the result of body() in an if directive with a few branches"""
+    name = r.choice(['PLATFORM', 'BUILD'])
+    values = VALUES[name]
+    lines = [f'/*$if {name} = {values[0]}*/'] + body()
+    for value in values[1:r.randint(1, len(values))]:
+        lines += [f'/*$elseif {name} = {value}*/'] + body()
+    if r.random() < 0.5:
+        lines += ['/*$else*/'] + body()
+    return lines + ['/*$fi*/']
+
+def code(r, lines):
+    """Ordinary code with an occasional small if directive"""
+    result = []
+    while len(result) < lines:
+        if r.random() < 0.05:
+            result += if_block(r, lambda: [statement(r) for _ in range(r.randint(1, 4))])
+        else:
+            result.append(statement(r))
+    return result
+
+def fill(size, produce):
+    """Joins the lists of lines returned by produce() until they add up to about size characters"""
+    lines = []
+    total = 0
+    while total < size:
+        more = produce()
+        lines += more
+        total += sum(len(line) + 1 for line in more)
+    return '\n'.join(lines) + '\n'
+
+def minified(r, size):
+    chunk = ' '.join(code(r, 200)).replace('// a comment with a { brace', '/* no line comments */')
+    return chunk * max(1, size // len(chunk)) + '\n'
+
+def nested(r, size):
+    def block(depth):
+        lines = ['function level() {']
+        if r.random() < 0.3:
+            lines.append(f'/*$define local = v{depth}*/')
+        if depth > 1:
+            lines += [f'/*$if {condition(r)}*/'] + block(depth - 1) + ['/*$else*/', statement(r), '/*$fi*/']
+        else:
+            lines.append(statement(r))
+        lines.append('/*$if local*/ localOnly(); /*$fi*/')
+        return lines + ['}']
+    return fill(size, lambda: block(r.randint(20, 60)))
+
+def directives(r, size):
+    def produce():
+        k = r.random()
+        if k < 0.2:
+            return [f'/*$define feature = {r.choice(["on", "off"])}*/']
+        elif k < 0.3:
+            return ['{ /*$define local = on*/ /*$undefine local*/ }']
+        elif k < 0.4:
+            return [f'/*$note {statement(r)}*/']
+        return if_block(r, lambda: [f'/*$if {condition(r)}*/ x(); /*$fi*/'])
+    return '/*$define feature = on < on, off*/\n' + fill(size, produce)
+
+def templates(r, size):
+    def template(depth):
+        if depth == 0 or r.random() < 0.3:
+            return '`text ${value} more`'
+        inner = template(depth - 1)
+        return r.choice([
+            f'`outer ${{ {inner} }} tail`',
+            f'`first line\nsecond ${{ f({{ a: {inner} }}) }}\nthird`',
+            f'`a ${{x}} b ${{ {inner} }} c`',
+            ])
+    def produce():
+        lines = [f'const t = {template(4)};']
+        if r.random() < 0.2:
+            lines += if_block(r, lambda: [f'use({template(2)});'])
+        return lines
+    return fill(size, produce)
+
+def dead(r, size):
+    def produce():
+        # the configuration is web, so the node and electron blocks are discarded
+        return (
+            ['/*$if PLATFORM = node*/'] + code(r, 2000)
+            + ['/*$elseif PLATFORM = electron*/'] + code(r, 2000)
+            + ['/*$else*/'] + code(r, 20)
+            + ['/*$fi*/']
+            )
+    return fill(size, produce)
+
+def generate(out_dir, kind, seed=0, scale=1.0):
+    """Writes a corpus of the given kind to out_dir, along with a configuration file
+named config.js. Returns the names of the source files, relative to out_dir."""
+    r = random.Random(f'{kind}:{seed}')
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, 'config.js'), 'w') as f:
+        f.write(CONFIG)
+    size = int(4_000_000 * scale)
+    if kind == 'tree':
+        files = {f'dir{i // 50:03}/file{i:05}.js': '\n'.join(code(r, r.randint(20, 120))) + '\n' for i in range(int(2000 * scale))}
+    else:
+        generator = globals()[kind]
+        files = {f'{kind}{i}.js': generator(r, size // 4) for i in range(4)}
+    for (name, text) in files.items():
+        os.makedirs(os.path.dirname(os.path.join(out_dir, name)), exist_ok=True)
+        with open(os.path.join(out_dir, name), 'w') as f:
+            f.write(text)
+    return sorted(files)
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates synthetic source trees for benchmarking jprep.")
+    parser.add_argument("out_dir", help="directory in which to write one subdirectory per kind of corpus")
+    parser.add_argument("--kinds", nargs='+', choices=KINDS, default=KINDS, help="which kinds of corpus to generate")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the random generator (defaults to 0)")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies the size of every corpus (defaults to 1)")
+    args = parser.parse_args()
+
+    for kind in args.kinds:
+        files = generate(os.path.join(args.out_dir, kind), kind, args.seed, args.scale)
+        print(f'{kind}: {len(files)} files')
+    return 0
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""
+Regression benchmark for scanning very long lines.
+
+Minified bundles are usually a single enormous line, so jprep has to scan a
+line in time linear in its length. This generates single-line inputs of
+increasing size, preprocesses each one with jprep.py, and fails if the time
+per megabyte grows with the size of the line.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+JPREP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'jprep.py')
+
+# a chunk of minified looking code that exercises every kind of token jprep scans for
+CHUNK = (
+    'function f(a,b){return a+"str /*$note x*/ {"+b}'
+    "var s='it\\'s',t=`tmpl ${s+`in ${f(1,2)}`} /*$note*/`;"
+    '/*$if debug*/console.log(s);/*$fi*/'
+    '/* block { */for(var i=0;i<9;i++){s+=i}'
+    )
+
+def make_input(path, size):
+    """Writes a single line of about size bytes (and a trailing newline) to path"""
+    with open(path, 'w') as f:
+        f.write(CHUNK * (size // len(CHUNK)))
+        f.write('\n')
+
+def time_jprep(in_dir, out_dir, filename):
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, JPREP, '-i', in_dir, '-o', out_dir, filename],
+        check=True
+        )
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks that jprep scans long lines in linear time.")
+    parser.add_argument("--max_mb", type=int, default=10, help="size of the largest line, in megabytes")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=2.5,
+        help="maximum allowed ratio between the slowest and fastest time per megabyte"
+        )
+    args = parser.parse_args()
+
+    sizes = [max(1, args.max_mb // 8), max(1, args.max_mb // 2), args.max_mb]
+    with tempfile.TemporaryDirectory() as tmp:
+        in_dir = os.path.join(tmp, 'in')
+        out_dir = os.path.join(tmp, 'out')
+        os.makedirs(in_dir)
+        rates = []
+        for mb in sizes:
+            filename = f'line_{mb}mb.js'
+            make_input(os.path.join(in_dir, filename), mb * 1024 * 1024)
+            seconds = time_jprep(in_dir, out_dir, filename)
+            rates.append(seconds / mb)
+            print(f'{mb:>4} MB: {seconds:8.3f} s  ({mb / seconds:7.2f} MB/s)')
+
+    ratio = max(rates) / min(rates)
+    print(f'slowest/fastest time per MB: {ratio:.2f}')
+    if ratio > args.tolerance:
+        print('FAIL: scanning time is not linear in the line length')
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    exit(main())
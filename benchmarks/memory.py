@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""
+Checks that jprep preprocesses large inputs in bounded memory.
+
+Generates inputs of about --size megabytes each (written a piece at a time, so that
+generating them takes little memory), then preprocesses each of them in-process with
+tracemalloc running, and reports the peak memory allocated while doing so:
+  long-line    a single line of minified code as long as the whole input
+  lines        ordinary code
+  dead         huge branches that the configuration discards
+  replay       the long line again, replayed from a DirectiveIndex recorded beforehand
+               (the index itself is not counted)
+  source-maps  the long line, with a column source map being built
+Exits with a failure if any of them peaks above --limit megabytes.
+"""
+
+import argparse
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import corpus
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+CASES = ['long-line', 'lines', 'dead', 'replay', 'source-maps']
+
+def load_jprep():
+    sys.path.insert(0, ROOT)
+    import jprep
+    return jprep
+
+def write_input(path, kind, size):
+    """Writes about size characters of the given kind of input to path"""
+    r = random.Random(kind)
+    with open(path, 'w', newline='') as f:
+        written = 0
+        if kind == 'lines':
+            block = '\n'.join(corpus.code(r, 20000)) + '\n'
+        elif kind == 'dead':
+            block = corpus.dead(r, 1 << 20)
+        else:
+            # a chunk of a minified bundle, without its line ending
+            block = corpus.minified(r, 1 << 20)[:-1] + ' '
+        while written < size:
+            f.write(block)
+            written += len(block)
+        if not block.endswith('\n'):
+            f.write('\n')
+
+def measure(jprep, env, path, **options):
+    """Preprocesses the file at path, and returns the peak memory allocated while doing so,
+in bytes, along with the time taken and any warnings"""
+    warnings = []
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    with open(path, 'r', newline='') as in_file:
+        targets = [(jprep.NullOut(), jprep.ParsingEnvironment.from_base_env(env))]
+        [error] = jprep.do_preprocess_many(in_file, targets, warn=warnings.append, **options)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    if error is not None:
+        raise Exception(f'{path}: {error}')
+    return peak, elapsed, warnings
+
+def run_case(jprep, env, work_dir, case, size, buffer_size):
+    kind = {'lines': 'lines', 'dead': 'dead'}.get(case, 'long-line')
+    path = os.path.join(work_dir, kind + '.js')
+    if not os.path.exists(path):
+        write_input(path, kind, size)
+    if case == 'replay':
+        index = jprep.DirectiveIndex()
+        with open(path, 'r', newline='') as in_file:
+            jprep.do_preprocess_many(in_file, [(jprep.NullOut(), jprep.ParsingEnvironment.from_base_env(env))], index=index)
+        return measure(jprep, env, path, index=index, buffer_size=buffer_size)
+    if case == 'source-maps':
+        source_map = jprep.SourceMap(jprep.NullOut(), path, path + '.out', columns=True)
+        return measure(jprep, env, path, source_maps=[source_map], buffer_size=buffer_size)
+    return measure(jprep, env, path, buffer_size=buffer_size)
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks that jprep preprocesses large inputs in bounded memory.")
+    parser.add_argument("--cases", nargs='+', choices=CASES, default=CASES, help="which inputs to check")
+    parser.add_argument("--size", type=int, default=100, metavar="MB", help="size of each input in megabytes (defaults to 100)")
+    parser.add_argument("--limit", type=int, default=32, metavar="MB", help="peak memory in megabytes above which a check fails (defaults to 32)")
+    parser.add_argument("--buffer_size", type=int, default=None, metavar="KB", help="the --buffer_size to preprocess with (defaults to jprep's default)")
+    args = parser.parse_args()
+
+    jprep = load_jprep()
+    env = jprep.ParsingEnvironment()
+    jprep.do_preprocess(io.StringIO(corpus.CONFIG), jprep.NullOut(), env)
+    buffer_size = args.buffer_size << 10 if args.buffer_size else None
+    failures = 0
+    with tempfile.TemporaryDirectory() as work_dir:
+        for case in args.cases:
+            peak, elapsed, warnings = run_case(jprep, env, work_dir, case, args.size << 20, buffer_size)
+            flag = ''
+            if peak > args.limit << 20:
+                flag = '  OVER LIMIT'
+                failures += 1
+            print(f'{case:<12} {peak / (1 << 20):8.1f} MB peak {elapsed:8.1f} s{flag}', flush=True)
+            for warning in warnings:
+                print(f'  {warning}')
+    if failures:
+        print(f'FAIL: {failures} input(s) took more than {args.limit} MB')
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+"""
+Benchmark suite for jprep.
+
+Generates the synthetic corpora in corpus.py, then times:
+  do_preprocess     the parser on each corpus, in-process, from memory to nowhere,
+                    with the usual scanner and with the token index (which
+                    do_preprocess_many only has for this comparison)
+  preprocess_config parsing a large configuration file
+  cli               jprep.py end to end on each corpus (and on the tree of many
+                    files, found with --recursive, also with a process per CPU,
+                    and on a simulated slow file system with and without
+                    --io_threads)
+Each benchmark runs in a process of its own, so that its peak RSS can be reported
+along with its throughput. Results can be saved as a baseline, and later runs are
+compared against it; a benchmark whose throughput drops by more than --tolerance
+counts as a regression, and makes this exit with a failure.
+"""
+
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import corpus
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+JPREP = os.path.join(ROOT, 'jprep.py')
+SLOW_FS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'slow_fs.py')
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+#--------------------------------------------------------------------------------------------------
+# Benchmarks that run inside a child process
+
+def load_jprep():
+    sys.path.insert(0, ROOT)
+    import jprep
+    return jprep
+
+def base_env(jprep, corpus_dir):
+    env = jprep.ParsingEnvironment()
+    with open(os.path.join(corpus_dir, 'config.js'), 'r', newline='') as f:
+        jprep.do_preprocess(f, jprep.NullOut(), env)
+    return env
+
+def time_do_preprocess(corpus_dir, files, repeat, token_index=False):
+    """Best time to preprocess every file, which are all read into memory beforehand"""
+    jprep = load_jprep()
+    env = base_env(jprep, corpus_dir)
+    texts = []
+    for filename in files:
+        with open(os.path.join(corpus_dir, filename), 'r', newline='') as f:
+            texts.append(f.read())
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in texts:
+            targets = [(jprep.NullOut(), jprep.ParsingEnvironment.from_base_env(env))]
+            jprep.do_preprocess_many(io.StringIO(text), targets, _token_index=token_index)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def time_preprocess_config(config_path, repeat):
+    """Best time to parse the configuration file at config_path"""
+    jprep = load_jprep()
+    ctx = jprep.RunContext(argparse.Namespace(
+        out_dir=os.path.dirname(config_path),
+        configuration=config_path,
+        strict_define=False
+        ))
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        if not jprep.preprocess_config(ctx, config_path, jprep.ParsingEnvironment()):
+            raise Exception('The configuration has errors')
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+#--------------------------------------------------------------------------------------------------
+# Running benchmarks
+
+def run_child(command):
+    """Runs command to completion, and returns its output, wall time, and peak RSS in MB"""
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    output = process.stdout.read()
+    process.stdout.close()
+    (_, status, usage) = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise Exception(f'{command} failed with exit code {process.returncode}')
+    # ru_maxrss is in kilobytes on Linux, and bytes on macOS
+    rss = usage.ru_maxrss / (1 << 20 if sys.platform == 'darwin' else 1 << 10)
+    return output, elapsed, rss
+
+def corpus_size(corpus_dir, files):
+    return sum(os.path.getsize(os.path.join(corpus_dir, filename)) for filename in files)
+
+def make_config(path, definitions):
+    """Writes a large configuration file to path"""
+    with open(path, 'w') as f:
+        for i in range(definitions):
+            f.write(f'/*$define NAME{i} = value{i % 7} < value0, value1, value2, value3, value4, value5, value6*/\n')
+            if i % 10 == 0:
+                f.write(f'/*$if NAME{i} = value3*/ /*$define EXTRA{i}*/ /*$fi*/\n')
+
+def run_benchmarks(args, work_dir):
+    results = {}
+
+    def record(name, size, seconds, rss):
+        mb = size / (1 << 20)
+        results[name] = {'mb': round(mb, 3), 'seconds': round(seconds, 4), 'mb_per_s': round(mb / seconds, 3), 'peak_rss_mb': round(rss, 1)}
+        print(f'{name:<32} {mb:8.2f} MB {seconds:8.3f} s {mb / seconds:8.2f} MB/s {rss:8.1f} MB RSS', flush=True)
+
+    for kind in args.kinds:
+        corpus_dir = os.path.join(work_dir, 'corpus', kind)
+        files = corpus.generate(corpus_dir, kind, args.seed, args.scale)
+        size = corpus_size(corpus_dir, files)
+
+        if kind != 'tree':
+            for token_index in [False, True]:
+                output, _, rss = run_child([
+                    sys.executable, __file__, '--child', 'do_preprocess', '--repeat', str(args.repeat)
+                    ] + (['--token_index'] if token_index else []) + [corpus_dir] + files)
+                record(f'do_preprocess/{kind}' + ('/token-index' if token_index else ''), size, float(output), rss)
+
+        # (name, script, extra options) of each way of running the command line
+        runs = [('', JPREP, [])]
+        if kind == 'tree':
+            runs += [
+                ('/all-cpus', JPREP, ['-j', '0']),
+                ('/slow-fs', SLOW_FS, []),
+                ('/slow-fs/io-threads', SLOW_FS, ['--io_threads', '16']),
+                ]
+        for (suffix, script, options) in runs:
+            out_dir = os.path.join(work_dir, 'out', kind + suffix.replace('/', '-'))
+            best = None
+            for _ in range(args.repeat):
+                _, elapsed, rss = run_child([
+                    sys.executable, script, '-i', corpus_dir, '-o', out_dir,
+                    '-c', os.path.join(corpus_dir, 'config.js')
+                    ] + options + (['--recursive'] if kind == 'tree' else files))
+                best = elapsed if best is None else min(best, elapsed)
+            record(f'cli/{kind}{suffix}', size, best, rss)
+
+    config_path = os.path.join(work_dir, 'big_config.js')
+    make_config(config_path, int(20000 * args.scale))
+    output, _, rss = run_child([
+        sys.executable, __file__, '--child', 'preprocess_config',
+        '--repeat', str(args.repeat), config_path
+        ])
+    record('preprocess_config', os.path.getsize(config_path), float(output), rss)
+    return results
+
+def compare(results, baseline, tolerance):
+    """Prints how results compare to baseline, and returns the names of any regressions"""
+    regressions = []
+    print()
+    print(f'{"benchmark":<32} {"baseline":>10} {"current":>10} {"change":>8}')
+    for (name, result) in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]['mb_per_s']
+        after = result['mb_per_s']
+        change = after / before - 1
+        flag = ''
+        if change < -tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f'{name:<32} {before:10.2f} {after:10.2f} {change:+8.1%}{flag}')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks jprep on synthetic corpora.")
+    parser.add_argument("--kinds", nargs='+', choices=corpus.KINDS, default=corpus.KINDS, help="which corpora to benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the corpus generator (defaults to 0)")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies the size of every corpus (defaults to 1)")
+    parser.add_argument("--repeat", type=int, default=3, help="number of times to run each benchmark, keeping the best (defaults to 3)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline results to compare against (defaults to benchmarks/baseline.json)")
+    parser.add_argument("--save_baseline", action="store_true", help="save the results as the new baseline instead of comparing against it")
+    parser.add_argument("--output", default=None, help="also write the results to this JSON file")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.15,
+        help="fraction by which throughput can drop below the baseline before it counts as a regression (defaults to 0.15)"
+        )
+    # used to run a single benchmark in a child process
+    parser.add_argument("--child", choices=['do_preprocess', 'preprocess_config'], help=argparse.SUPPRESS)
+    parser.add_argument("--token_index", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("paths", nargs='*', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child == 'do_preprocess':
+        print(time_do_preprocess(args.paths[0], args.paths[1:], args.repeat, args.token_index))
+        return 0
+    if args.child == 'preprocess_config':
+        print(time_preprocess_config(args.paths[0], args.repeat))
+        return 0
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = run_benchmarks(args, work_dir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f'Saved the baseline to {args.baseline}')
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f'There is no baseline at {args.baseline} to compare against; save one with --save_baseline')
+        return 0
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f'FAIL: {len(regressions)} benchmark(s) regressed')
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+
+"""
+Runs jprep.py as if its files were on a slow (such as a network) file system, by
+delaying every file system call it makes. Takes the same arguments as jprep.py;
+the delay, in milliseconds, is read from the SLOW_FS_DELAY environment variable
+(defaults to 2).
+"""
+
+import builtins
+import io
+import os
+import runpy
+import sys
+import time
+
+JPREP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'jprep.py')
+
+def delayed(func, delay):
+    def delayed_func(*args, **kwargs):
+        time.sleep(delay)
+        return func(*args, **kwargs)
+    return delayed_func
+
+def main():
+    delay = float(os.environ.get('SLOW_FS_DELAY', '2')) / 1000
+    for name in ['stat', 'lstat', 'scandir', 'replace', 'chmod', 'remove', 'utime', 'makedirs']:
+        setattr(os, name, delayed(getattr(os, name), delay))
+    builtins.open = io.open = delayed(builtins.open, delay)
+    sys.argv = [JPREP] + sys.argv[1:]
+    # as when jprep.py is run directly, so that it can import jprep_core
+    sys.path.insert(0, os.path.dirname(JPREP))
+    runpy.run_path(JPREP, run_name='__main__')
+
+if __name__ == '__main__':
+    main()
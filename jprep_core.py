@@ -0,0 +1,3396 @@
+"""
+A very basic JavaScript/TypeScript preprocessor.
+
+This is the implementation; jprep.py is the command line entry point, and importing
+jprep gives this module.
+
+Written by TheOnlyOne (@modest_ralts, https://github.com/LumenTheFairy).
+"""
+
+# Constants
+VERSION = "1.0"
+DEFAULT_IN_DIR = "./"
+DEFAULT_OUT_DIR = "./preprocessed/"
+
+ID_CH = r'[\w$]'
+
+# number of characters read from an input file at a time
+CHUNK_SIZE = 1 << 20
+
+# files found by --recursive when there is no --include
+DEFAULT_INCLUDE = ['*.js', '*.jsx', '*.mjs', '*.cjs', '*.ts', '*.tsx', '*.mts', '*.cts']
+
+# environment variable that can hold definitions, in the same form as -D
+DEFINES_ENV_VAR = "JPREP_DEFINES"
+
+
+from sys import stderr
+import sys
+import os
+import json
+import hashlib
+import copy
+import io
+import time
+from stat import S_IREAD, S_IRGRP, S_IROTH, S_IWUSR
+import re
+import itertools
+from enum import Enum, auto
+# modules only needed by optional modes (such as shutil, mmap, codecs, fnmatch, array and
+# bisect) are imported where they are used, so that a plain run does not pay for them
+
+# Setup logging
+# The logging module is only imported, and the logger only set up, once something is actually
+# logged (or log is used), which a successful run without --verbose never does. The levels
+# match those in logging.
+LOG_ERROR_LEVEL_NUM = 40
+LOG_INFO_LEVEL_NUM = 20
+LOG_VERBOSE_LEVEL_NUM = 15
+_log = None
+log_level = LOG_INFO_LEVEL_NUM
+
+def get_log():
+    global _log
+    if _log is None:
+        import logging
+        _log = logging.getLogger('log')
+        formatter = logging.Formatter("[jprep: %(asctime)-15s] %(message)s")
+        handler = logging.StreamHandler()
+        handler.setFormatter(formatter)
+        _log.addHandler(handler)
+        _log.setLevel(log_level)
+        logging.addLevelName(LOG_VERBOSE_LEVEL_NUM, "VERBOSE")
+        def log_verbose(self, message, *args, **kws):
+            if self.isEnabledFor(LOG_VERBOSE_LEVEL_NUM):
+                self._log(LOG_VERBOSE_LEVEL_NUM, message, args, **kws)
+        logging.Logger.verbose = log_verbose
+    return _log
+
+def set_log_level(level):
+    global log_level
+    log_level = level
+    if _log is not None:
+        _log.setLevel(level)
+
+def __getattr__(name):
+    # log is the logger, which is set up on first use
+    if name == 'log':
+        return get_log()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def parseArguments():
+    import argparse
+
+    # Create argument parser
+    parser = argparse.ArgumentParser(description="Preprocesses the given JavaScript/TypeScript files.")
+
+    # Positional mandatory arguments
+    parser.add_argument("files", nargs='*', help='list of files to preprocess; "-" on its own is the same as --stdio')
+
+    # Optional Arguments
+    parser.add_argument(
+        "-i", "--in_dir",
+        default=DEFAULT_IN_DIR,
+        help=f'directory the input files are relative to (defaults to "{DEFAULT_IN_DIR}")'
+        )
+    parser.add_argument(
+        "-o", "--out_dir",
+        default=DEFAULT_OUT_DIR,
+        help=f'directory in which to write the output files (defaults to "{DEFAULT_OUT_DIR}")'
+        )
+    parser.add_argument(
+        "--recursive",
+        action="store_true",
+        help="also preprocess every file under the input directory (other than the output directories) that matches --include and not --exclude, starting on each file as soon as it is found"
+        )
+    parser.add_argument(
+        "--include",
+        action="append",
+        metavar="GLOB",
+        help='with --recursive, only preprocess files that match GLOB; a GLOB with no "/" is matched against file names, and one with a "/" against paths relative to the input directory; this can be given several times (defaults to JavaScript and TypeScript files)'
+        )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        metavar="GLOB",
+        help="with --recursive, skip files and directories that match GLOB, in the same way as --include; this can be given several times"
+        )
+    parser.add_argument(
+        "-r", "--readonly",
+        action="store_true",
+        help='preprocessed files will be saved in readonly mode, to help prevent accidental edits'
+        )
+    parser.add_argument(
+        "-k", "--keep_unchanged",
+        action="store_true",
+        help="outputs whose new contents are the same as the existing file are left alone, keeping their modification time, so that tools watching them do not rebuild"
+        )
+    parser.add_argument(
+        "--source_maps",
+        action="store_true",
+        help='write a version 3 source map next to each output, named after it with ".map" added, which maps each line of the output back to where it came from in the input'
+        )
+    parser.add_argument(
+        "--source_map_columns",
+        action="store_true",
+        help="with --source_maps, map each token of the output rather than only the start of each line"
+        )
+    parser.add_argument(
+        "-c", "--configuration",
+        default=None,
+        help=f'configuration file which holds definitions that stay in scope for all preprocessed files'
+        )
+    parser.add_argument(
+        "--variant",
+        nargs=2,
+        action="append",
+        metavar=("CONFIGURATION", "OUT_DIR"),
+        help="preprocess the files with the definitions in CONFIGURATION (on top of any --configuration), writing them to OUT_DIR instead of --out_dir; this can be given several times, and each file is still only read and scanned once for all variants"
+        )
+    parser.add_argument(
+        "-D", "--define",
+        action="append",
+        dest="defines",
+        metavar="NAME[=VALUE]",
+        help=f"define NAME (with VALUE, if given) for all preprocessed files, on top of the configuration; this can be given several times, and more definitions can be given in the {DEFINES_ENV_VAR} environment variable, separated by spaces"
+        )
+    parser.add_argument(
+        "--defines_json",
+        default=None,
+        metavar="JSON_FILE",
+        help='JSON file of definitions for all preprocessed files, on top of the configuration: an object that maps each name to its value (or null for no value), or to an object with a "value" and a list of "choices"'
+        )
+    parser.add_argument(
+        "-b", "--build_off",
+        action="store_true",
+        help="only preprocess files that can be determined to need preprocessing"
+        )
+    parser.add_argument(
+        "-s", "--strict_define",
+        action="store_true",
+        help="makes it an error for a define to have no value or a condition not to check against a value, or when a condition uses a value that has not been defined in the current scope"
+        )
+    parser.add_argument(
+        "-f", "--fast_copy",
+        action="store_true",
+        help="files that contain no directives are copied to the output byte for byte, without being parsed"
+        )
+    parser.add_argument(
+        "--validate",
+        action="store_true",
+        help="with --fast_copy, still parse files that contain no directives to check that their braces are balanced"
+        )
+    parser.add_argument(
+        "--index_cache",
+        default=None,
+        metavar="CACHE_DIR",
+        help="directory in which to keep an index of the directives in each file, so that files whose contents have not changed can be preprocessed again without scanning them"
+        )
+    parser.add_argument(
+        "--index_cache_size",
+        type=int,
+        default=64,
+        metavar="MB",
+        help="with --index_cache, the size in megabytes past which the least recently used indexes are removed (defaults to 64)"
+        )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=1,
+        help="number of files to preprocess in parallel; 0 uses one process per CPU (defaults to 1)"
+        )
+    parser.add_argument(
+        "--buffer_size",
+        type=int,
+        default=CHUNK_SIZE >> 10,
+        metavar="KB",
+        help="size in kilobytes of the chunks input is read in; a line longer than this is split into pieces that are scanned one at a time, so that memory use does not grow with the length of lines, unless it cannot be split (such as inside a directive), which is reported (defaults to 1024)"
+        )
+    parser.add_argument(
+        "--io_threads",
+        type=int,
+        default=1,
+        metavar="THREADS",
+        help="number of files to work on at once in a single process, so that waiting on a slow file system (such as a network file system) for one file overlaps with working on others; this cannot be combined with --jobs or --profile (defaults to 1)"
+        )
+    parser.add_argument(
+        "-w", "--watch",
+        action="store_true",
+        help="keep running after preprocessing, and preprocess files again whenever they or the configuration file change; with --recursive, new files in the input directory are preprocessed as well"
+        )
+    parser.add_argument(
+        "--debounce",
+        type=int,
+        default=10,
+        help="with --watch, milliseconds to wait for more changes before preprocessing (defaults to 10)"
+        )
+    parser.add_argument(
+        "--stdio",
+        action="store_true",
+        help="preprocess standard input to standard output instead of preprocessing files, streaming it through in chunks"
+        )
+    parser.add_argument(
+        "--framed",
+        action="store_true",
+        help="preprocess any number of sources, one after another, read from standard input and written to standard output as length-prefixed frames of UTF-8; each source is sent as a 4 byte big-endian length followed by its text, and each reply is a status byte (0 for success, 1 for an error), then the length and text of the output or the error message"
+        )
+    parser.add_argument(
+        "--stats",
+        default=None,
+        metavar="REPORT",
+        help="measure how long each file takes to preprocess and what is in it, log a summary of the slowest files, and write the full report to REPORT as JSON"
+        )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        metavar="PSTATS_FILE",
+        help="run the preprocessor under cProfile, and write the results to PSTATS_FILE (which can be read with the pstats module)"
+        )
+    parser.add_argument("--verbose", action="store_true", help="display additional information during preprocessing")
+
+    # Print version
+    parser.add_argument("-v", "--version", action="version", version=f'%(prog)s - Version {VERSION}')
+
+    # Parse arguments
+    args = parser.parse_args()
+    if args.files == ['-']:
+        args.files = []
+        args.stdio = True
+    if args.stdio or args.framed:
+        if args.stdio and args.framed:
+            parser.error('--stdio and --framed cannot be used together')
+        if args.files or args.recursive or args.variant or args.watch or args.stats or args.source_maps:
+            parser.error('with --stdio or --framed, no files can be listed, and --recursive, --variant, --watch, --stats and --source_maps cannot be used')
+    elif not args.files and not args.recursive:
+        parser.error('no files to preprocess; list them, or give --recursive')
+    if args.io_threads > 1 and (args.jobs != 1 or args.profile):
+        parser.error('--io_threads cannot be combined with --jobs or --profile')
+    if args.buffer_size < 1:
+        parser.error('--buffer_size must be at least 1')
+    return args
+
+class Variant:
+    """One configuration that files are preprocessed under, along with the directory
+its output goes to and the build manifest for that directory"""
+    def __init__(self, out_dir, configuration=None):
+        self.out_dir = out_dir
+        self.configuration = configuration
+        self.global_env = ParsingEnvironment()
+        self.manifest = BuildManifest(out_dir)
+        self.snapshot = ConfigSnapshot(out_dir)
+
+    def observe(self, name):
+        """What a file sees when it looks up name in the configuration"""
+        entry = self.global_env.lookup(name)
+        return entry and [entry.value, entry.choices]
+
+class RunContext:
+    """Holds the state of a single run of the preprocessor: the parsed arguments,
+the variants being built (usually just one, for --configuration and --out_dir),
+and the exit code. Nothing about a run is kept in module globals, so a context
+can be copied into worker processes.
+If messages is a list, log messages are collected in it as (level, message)
+pairs instead of being logged, so that they can be logged later in a
+deterministic order."""
+    def __init__(self, args):
+        self.args = args
+        if getattr(args, 'variant', None):
+            self.variants = [Variant(out_dir, configuration) for (configuration, out_dir) in args.variant]
+        else:
+            self.variants = [Variant(args.out_dir)]
+        if getattr(args, 'index_cache', None):
+            self.index_cache = IndexCache(args.index_cache, args.index_cache_size << 20)
+        else:
+            self.index_cache = None
+        self.exit_code = 0
+        self.messages = None
+        self._options_hash = None
+        # with --stats, the FileStats of each file preprocessed in the current build
+        self.file_stats = [] if getattr(args, 'stats', None) else None
+        # with --profile, the profiler for this process, and the results sent back by workers
+        self.profiler = None
+        self.worker_profiles = []
+        # the output directories that are known to exist
+        self.made_dirs = set()
+
+    def log(self, level, message):
+        if self.messages is None:
+            # once the logger is set up, its own level (which may have been changed through log) decides
+            if _log is not None or level >= log_level:
+                get_log().log(level, message)
+        else:
+            self.messages.append((level, message))
+
+    def error(self, message):
+        self.exit_code = -1
+        self.log(LOG_ERROR_LEVEL_NUM, str(message))
+
+    def verbose(self, message):
+        self.log(LOG_VERBOSE_LEVEL_NUM, message)
+
+    def options_hash(self):
+        """A hash of the options that change how files are preprocessed"""
+        if self._options_hash is None:
+            options = [self.args.strict_define, self.args.fast_copy, self.args.validate, self.args.source_maps, self.args.source_map_columns]
+            self._options_hash = hash_bytes(json.dumps(options).encode())
+        return self._options_hash
+
+    def config_paths(self):
+        """All configuration files used by this run, including any --defines_json"""
+        paths = [self.args.configuration] if self.args.configuration else []
+        if getattr(self.args, 'defines_json', None):
+            paths.append(self.args.defines_json)
+        return paths + [variant.configuration for variant in self.variants if variant.configuration]
+
+    def make_dir(self, path):
+        """Creates the directory at path (and its parents) unless it is already known to exist"""
+        if path in self.made_dirs:
+            return
+        if not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+            self.verbose(f'Output directory "{path}" created.')
+        self.made_dirs.add(path)
+
+    def profiled(self, func, *args):
+        """Calls func(*args), under the profiler if there is one"""
+        if not getattr(self.args, 'profile', None):
+            return func(*args)
+        if self.profiler is None:
+            import cProfile
+            self.profiler = cProfile.Profile()
+        return self.profiler.runcall(func, *args)
+
+    def take_profile(self):
+        """Stops the profiler, and returns its results in a form that can be sent between processes"""
+        profiler = self.profiler
+        if profiler is None:
+            return None
+        self.profiler = None
+        profiler.create_stats()
+        return profiler.stats
+
+    def finish_build(self):
+        """Saves the build manifest of each variant, trims the index cache, and writes
+the --stats report and --profile results for the build"""
+        for variant in self.variants:
+            variant.manifest.save()
+        if self.index_cache:
+            self.index_cache.trim()
+        if self.file_stats is not None:
+            write_stats_report(self, self.args.stats, self.file_stats)
+            self.file_stats = []
+        if getattr(self.args, 'profile', None):
+            write_profile(self, self.args.profile)
+
+    def __getstate__(self):
+        # a profiler cannot be copied into a worker process; each worker makes its own
+        state = self.__dict__.copy()
+        state['profiler'] = None
+        return state
+
+def atomic_streamed_file_process(in_path, out_path, process_func, binary=False, readonly=False, keep_unchanged=False):
+    """Effectively reads from the file at in_path, processes it with
+process_func, and writes the result to out_path. However, if process_func
+fails, we don't want to leave a partially written file on disk (especially
+if that means the old file has already been discarded.) Yet, we still want to
+be able to stream from one file to another to keep memory usage as low as
+possible. This function achieves these by creating writing the result to a
+temporary file, and only if process_func succeeds, it will replace the real
+output file. Otherwise (including if it raises an exception), the temporary
+file is simply discarded.
+process_func is given a file open for reading, and a file open for writing,
+and is expected to return the a boolean indicating its success. If binary is
+set, both files are opened in binary mode instead of text mode. If readonly is
+set, the output file is left in readonly mode. If keep_unchanged is set and the
+result is the same as the existing output file, that file is not touched at all."""
+    [success] = atomic_streamed_multi_file_process(
+        in_path, [out_path],
+        lambda in_file, out_files: [process_func(in_file, out_files[0])],
+        binary, readonly, keep_unchanged
+        )
+    return success
+
+def atomic_streamed_multi_file_process(in_path, out_paths, process_func, binary=False, readonly=False, keep_unchanged=False):
+    """Like atomic_streamed_file_process, but produces several output files from a
+single pass over the input. process_func is given a file open for reading, and a
+list of files open for writing (one for each of out_paths), and is expected to
+return a list of booleans indicating which of the outputs succeeded. Only those
+replace their output files (and with keep_unchanged, only if they changed)."""
+    from contextlib import ExitStack
+    in_mode, out_mode = ('rb', 'wb') if binary else ('r', 'w')
+    # text is never translated, so that line endings are kept byte for byte
+    newline = None if binary else ''
+    temp_paths = [out_path + '.temp' for out_path in out_paths]
+    try:
+        with ExitStack() as stack:
+            in_file = stack.enter_context(open(in_path, in_mode, newline=newline))
+            out_files = []
+            for (out_path, temp_path) in zip(out_paths, temp_paths):
+                if keep_unchanged and os.path.isfile(out_path):
+                    out_file = ComparingOutput(out_path, temp_path, None if binary else in_file.encoding)
+                else:
+                    out_file = open(temp_path, out_mode, newline=newline)
+                out_files.append(stack.enter_context(out_file))
+            successes = process_func(in_file, out_files)
+            changed = [
+                success and (not isinstance(out_file, ComparingOutput) or out_file.finish())
+                for (out_file, success) in zip(out_files, successes)
+                ]
+    except BaseException:
+        for temp_path in temp_paths:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        raise
+    for (out_path, temp_path, is_changed) in zip(out_paths, temp_paths, changed):
+        if is_changed:
+            if os.path.exists(out_path):
+                os.chmod(out_path, S_IWUSR|S_IREAD)
+            try:
+                os.replace(temp_path, out_path)
+            finally:
+                if readonly:
+                    os.chmod(out_path, S_IREAD|S_IRGRP|S_IROTH)
+        elif os.path.exists(temp_path):
+            os.remove(temp_path)
+    return successes
+
+class ComparingOutput:
+    """Takes the place of the temporary file for an output that already exists, in
+atomic_streamed_multi_file_process with keep_unchanged. For as long as what is written
+matches the existing file, it is only compared against it, and nothing is written. The
+temporary file is only created at the first difference, starting with the part that
+matched, copied from the existing file. Text is encoded with encoding before it is
+compared, so the existing file is only ever read as bytes."""
+    def __init__(self, out_path, temp_path, encoding=None):
+        self.old = open(out_path, 'rb')
+        self.temp_path = temp_path
+        import codecs
+        self.encode = codecs.getincrementalencoder(encoding)().encode if encoding else None
+        # the temporary file, once the output has changed
+        self.file = None
+        # how many bytes of the existing file have been matched
+        self.matched = 0
+
+    def write(self, data):
+        if self.encode:
+            data = self.encode(data)
+        if self.file is None:
+            if self.old.read(len(data)) == data:
+                self.matched += len(data)
+                return
+            self.start_temp_file()
+        self.file.write(data)
+
+    def start_temp_file(self):
+        self.file = open(self.temp_path, 'wb')
+        self.old.seek(0)
+        remaining = self.matched
+        while remaining:
+            chunk = self.old.read(min(remaining, CHUNK_SIZE))
+            self.file.write(chunk)
+            remaining -= len(chunk)
+
+    def finish(self):
+        """Returns whether the output has changed, in which case all of it is in the temporary file"""
+        if self.encode:
+            tail = self.encode('', final=True)
+            self.encode = None
+            self.write(tail)
+        if self.file is None:
+            if not self.old.read(1):
+                return False
+            self.start_temp_file()
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.old.close()
+        if self.file is not None:
+            self.file.close()
+
+def bulk_copy(in_file, out_file):
+    """A process_func for atomic_streamed_file_process (in binary mode) which
+copies the input to the output unchanged. The copy is done in the kernel with
+sendfile when the platform supports it (and out_file is a real file)."""
+    if hasattr(os, 'sendfile') and hasattr(out_file, 'fileno'):
+        in_fd = in_file.fileno()
+        out_fd = out_file.fileno()
+        size = os.fstat(in_fd).st_size
+        offset = 0
+        try:
+            while offset < size:
+                sent = os.sendfile(out_fd, in_fd, offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+            return True
+        except OSError:
+            # sendfile is not supported for these files; fall back to a normal copy
+            # (nothing has been written yet if it fails on the first call)
+            if offset != 0:
+                raise
+    import shutil
+    shutil.copyfileobj(in_file, out_file)
+    return True
+
+def has_directives(in_path):
+    """True if the file at in_path contains anything that could start a directive.
+This is conservative: a "/*$" inside a string or comment still counts."""
+    import mmap
+    with open(in_path, 'rb') as in_file:
+        if os.fstat(in_file.fileno()).st_size == 0:
+            # empty files cannot be memory-mapped
+            return False
+        with mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return data.find(b'/*$') != -1
+
+def hash_bytes(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def hash_file(path):
+    """Hash of the contents of the file at path"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+_jprep_id = None
+
+def jprep_id():
+    """Identifies this version of jprep, including any local changes to this script"""
+    global _jprep_id
+    if _jprep_id is None:
+        _jprep_id = f'{VERSION}+{hash_file(__file__)}'
+    return _jprep_id
+
+def file_record(path):
+    """Describes the current contents of the file at path, for the build manifest"""
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'hash': hash_file(path)}
+
+def matches_record(path, record):
+    """True if the file at path still has the contents described by record.
+The file is only hashed if its modification time has changed, and if it turns
+out to have the same contents anyway, record is updated with the new time."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return False
+    if st.st_size != record['size']:
+        return False
+    if st.st_mtime_ns == record['mtime_ns']:
+        return True
+    if hash_file(path) != record['hash']:
+        return False
+    record['mtime_ns'] = st.st_mtime_ns
+    return True
+
+class BuildManifest:
+    """Records what each file in the output directory was built from: the hash
+of its input, every configuration name it depended on and what it saw for
+them, a hash of the options, and the version of jprep, along with the hash of
+the output itself. The manifest is stored in the output
+directory, is only loaded once it is needed, and is always written atomically."""
+    FILENAME = '.jprep_manifest.json'
+    FORMAT = 2
+
+    def __init__(self, out_dir):
+        self.path = os.path.join(out_dir, self.FILENAME)
+        self.entries = None
+        self.dirty = False
+
+    def load(self):
+        if self.entries is None:
+            self.entries = {}
+            try:
+                with open(self.path, 'r') as f:
+                    data = json.load(f)
+                if data['format'] == self.FORMAT:
+                    self.entries = data['files']
+            except (OSError, ValueError, KeyError, TypeError):
+                # a missing or unreadable manifest just means everything gets built
+                pass
+        return self.entries
+
+    def get(self, filename):
+        return self.load().get(filename)
+
+    def update(self, filename, entry):
+        """Sets the entry for filename, or removes it if entry is None"""
+        entries = self.load()
+        if entry is None:
+            if filename in entries:
+                del entries[filename]
+                self.dirty = True
+        elif entries.get(filename) != entry:
+            entries[filename] = entry
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        with open(self.path + '.temp', 'w') as f:
+            json.dump({'format': self.FORMAT, 'files': self.entries}, f, separators=(',', ':'), sort_keys=True)
+        os.replace(self.path + '.temp', self.path)
+        self.dirty = False
+
+class ConfigSnapshot:
+    """The environment that a variant's configuration files produce, saved so that later
+runs can load it instead of parsing them again. It is keyed by the hash of the contents of
+the files, the options that affect how they are parsed, and the version of jprep; it is
+stored in the output directory, next to the build manifest, and is always written atomically."""
+    FILENAME = '.jprep_config.json'
+    FORMAT = 1
+
+    def __init__(self, out_dir):
+        self.path = os.path.join(out_dir, self.FILENAME)
+
+    def load(self, key):
+        """The environment saved under key, or None if there is none"""
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            if data['format'] != self.FORMAT or data['key'] != key:
+                return None
+            return ParsingEnvironment.from_snapshot(data['scopes'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, key, env):
+        try:
+            with open(self.path + '.temp', 'w') as f:
+                json.dump({'format': self.FORMAT, 'key': key, 'scopes': env.snapshot()}, f, separators=(',', ':'))
+            os.replace(self.path + '.temp', self.path)
+        except OSError:
+            # the snapshot only ever saves time; failing to write it is not an error
+            pass
+
+class IndexCache:
+    """An on-disk cache of the DirectiveIndex of each source file, keyed by the hash of
+its contents, so that a file that has not changed does not need to be scanned again
+when only the configuration has. Each index is stored in a file of its own, marked with
+the cache format and the version of jprep that made it; an index with any other marks
+is ignored. Once the cache is larger than max_size bytes, the least recently used
+indexes are removed."""
+    FORMAT = 1
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def path(self, content_hash):
+        return os.path.join(self.cache_dir, content_hash + '.json')
+
+    def get(self, content_hash):
+        """The cached index of the contents with content_hash, or None if there is none"""
+        path = self.path(content_hash)
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data['format'] != self.FORMAT or data['jprep'] != jprep_id():
+                return None
+            # mark it as recently used
+            os.utime(path)
+            return DirectiveIndex(data['ops'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def put(self, content_hash, index):
+        path = self.path(content_hash)
+        # several processes (or threads) may be writing the same index at once
+        import threading
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.temp'
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(temp_path, 'w') as f:
+                json.dump({'format': self.FORMAT, 'jprep': jprep_id(), 'ops': index.ops}, f, separators=(',', ':'))
+            os.replace(temp_path, path)
+        except OSError:
+            # the cache only ever saves time; failing to write to it is not an error
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def trim(self):
+        """Removes the least recently used indexes until the cache fits in max_size"""
+        try:
+            with os.scandir(self.cache_dir) as it:
+                indexes = [
+                    (st.st_mtime_ns, st.st_size, entry.path)
+                    for entry in it if entry.name.endswith('.json')
+                    for st in [entry.stat()]
+                    ]
+        except FileNotFoundError:
+            return
+        total = sum(size for (_, size, _) in indexes)
+        for (_, size, path) in sorted(indexes):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+class FileStats:
+    """Measurements of preprocessing a single file, for --stats.
+method is how the file was handled: "scanned", "replayed" (from the index cache), or "copied"
+(with --fast_copy). bytes_out is the total over all variants. The depths are those of the
+deepest scope entered and the deepest if directive, counting from the top level of the file
+(in code that is skipped over, or replayed from the index cache, braces are only seen as the
+depth they leave at the next directive).
+Times are in seconds: scan_time is spent scanning code, directive_time parsing and evaluating
+directives, and io_time opening, reading and writing files (which is all of the time for a
+copied file, including any --validate)."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.method = 'scanned'
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lines = 0
+        self.directives = {}
+        self.max_scope_depth = 0
+        self.max_if_depth = 0
+        self.scan_time = 0.0
+        self.directive_time = 0.0
+        self.io_time = 0.0
+        # time spent in do_preprocess_many, which is split up into the others once the file is done
+        self.preprocess_time = 0.0
+        # kind and start time of the directive being parsed
+        self.kind = None
+        self.directive_start = 0.0
+
+    def start_directive(self, env):
+        self.kind = 'note'
+        self.max_if_depth = max(self.max_if_depth, env.get_if_depth())
+        self.directive_start = time.perf_counter()
+
+    def end_directive(self):
+        self.directive_time += time.perf_counter() - self.directive_start
+        self.directives[self.kind] = self.directives.get(self.kind, 0) + 1
+
+    def enter_scope(self, env):
+        self.max_scope_depth = max(self.max_scope_depth, env.get_scope_depth() - env.base_depth)
+
+    def timed(self, process_func):
+        """Wraps a process_func for atomic_streamed_multi_file_process so that it is timed,
+along with the reading and writing it does"""
+        def timed_process_func(in_file, out_files):
+            reader = TimedFile(in_file, self)
+            start = time.perf_counter()
+            try:
+                return process_func(reader, [TimedFile(out_file, self) for out_file in out_files])
+            finally:
+                self.preprocess_time += time.perf_counter() - start
+                self.lines = reader.lines()
+        return timed_process_func
+
+    def finish(self, total_time, in_path, out_paths):
+        """Fills in the rest of the measurements once the file is done, given how long it took in all"""
+        self.bytes_in = os.path.getsize(in_path)
+        self.bytes_out = sum(os.path.getsize(path) for path in out_paths if os.path.exists(path))
+        if self.method == 'copied':
+            with open(in_path, 'rb') as f:
+                self.lines = count_lines(iter(lambda: f.read(CHUNK_SIZE), b''), b'\n')
+        self.scan_time = max(0.0, self.preprocess_time - self.directive_time - self.io_time)
+        self.io_time = max(0.0, total_time - self.scan_time - self.directive_time)
+
+    def report(self):
+        """The measurements as a dict, for the JSON report"""
+        keys = ['filename', 'method', 'bytes_in', 'bytes_out', 'lines', 'directives', 'max_scope_depth',
+            'max_if_depth', 'scan_time', 'directive_time', 'io_time']
+        return {key: getattr(self, key) for key in keys}
+
+def count_lines(chunks, newline):
+    """The number of lines in the text made up of chunks, counting a last line with no newline"""
+    count = 0
+    last = None
+    for chunk in chunks:
+        count += chunk.count(newline)
+        last = chunk
+    return count + (1 if last and not last.endswith(newline) else 0)
+
+class TimedFile:
+    """Passes reads and writes through to a file, adding the time they take to the io_time
+of a FileStats. The text that is read is kept track of only to count its lines."""
+    def __init__(self, file, stats):
+        self.file = file
+        self.stats = stats
+        self.newlines = 0
+        self.last = ''
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        text = self.file.read(size)
+        self.stats.io_time += time.perf_counter() - start
+        self.newlines += text.count('\n')
+        self.last = text or self.last
+        return text
+
+    def write(self, s):
+        start = time.perf_counter()
+        self.file.write(s)
+        self.stats.io_time += time.perf_counter() - start
+
+    def seek(self, offset):
+        # the file is only ever read again from the start
+        self.newlines = 0
+        self.last = ''
+        return self.file.seek(offset)
+
+    def lines(self):
+        return self.newlines + (1 if self.last and not self.last.endswith('\n') else 0)
+
+def stats_table(file_stats, rows=20):
+    """A table of the slowest rows files in file_stats, followed by the totals over all of them"""
+    def total_time(stats):
+        return stats.scan_time + stats.directive_time + stats.io_time
+    def row(stats):
+        return (
+            f'{stats.filename[-40:]:<40} {stats.bytes_in / 1024:>9.1f} {stats.bytes_out / 1024:>9.1f} {stats.lines:>8}'
+            f' {sum(stats.directives.values()):>6} {stats.max_scope_depth:>5} {stats.max_if_depth:>4}'
+            f' {stats.scan_time * 1000:>9.1f} {stats.directive_time * 1000:>9.1f} {stats.io_time * 1000:>9.1f}'
+            f' {total_time(stats) * 1000:>9.1f}'
+            )
+    total = FileStats(f'total ({len(file_stats)} files)')
+    for stats in file_stats:
+        for key in ['bytes_in', 'bytes_out', 'lines', 'scan_time', 'directive_time', 'io_time']:
+            setattr(total, key, getattr(total, key) + getattr(stats, key))
+        for (kind, count) in stats.directives.items():
+            total.directives[kind] = total.directives.get(kind, 0) + count
+        total.max_scope_depth = max(total.max_scope_depth, stats.max_scope_depth)
+        total.max_if_depth = max(total.max_if_depth, stats.max_if_depth)
+    slowest = sorted(file_stats, key=total_time, reverse=True)[:rows]
+    return '\n'.join(
+        [
+        f'{"file":<40} {"KB in":>9} {"KB out":>9} {"lines":>8} {"direc.":>6} {"scope":>5} {"if":>4}'
+        f' {"scan ms":>9} {"direc. ms":>9} {"I/O ms":>9} {"total ms":>9}'
+        ]
+        + [row(stats) for stats in slowest]
+        + [row(total)]
+        )
+
+def write_stats_report(ctx, path, file_stats):
+    """Logs a summary of file_stats, and writes all of it to path as JSON"""
+    if not file_stats:
+        ctx.verbose('No files were preprocessed, so there are no statistics to report.')
+        return
+    ctx.log(LOG_INFO_LEVEL_NUM, 'Statistics (slowest files first):\n' + stats_table(file_stats))
+    with open(path, 'w') as f:
+        json.dump({'jprep': VERSION, 'files': [stats.report() for stats in file_stats]}, f, indent=1)
+
+class ProfileData:
+    """Profiler results sent back by a worker process, in a form that pstats.Stats can load"""
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+def write_profile(ctx, path):
+    """Writes the results of profiling this process and any workers to path, and starts over"""
+    profiles = [ProfileData(stats) for stats in [ctx.take_profile()] + ctx.worker_profiles if stats]
+    ctx.worker_profiles = []
+    if not profiles:
+        ctx.verbose('Nothing was preprocessed, so there is no profile to write.')
+        return
+    import pstats
+    stats = pstats.Stats(*profiles)
+    stats.dump_stats(path)
+    ctx.verbose(f'Profile written to "{path}".')
+
+def should_preprocess(ctx, variant, entry, in_path, out_path):
+    """Determines if a file should be preprocessed for a variant, given its entry in the
+variant's build manifest.
+A file should be preprocessed for any of the following reasons:
+- We are doing a full build
+- The file has never been preprocessed before
+- The contents of the file have changed since the last time it was preprocessed
+- The output has been changed or removed since then
+- Its source map is wanted but missing
+- A configuration name the file checked has changed since then
+- The options have changed since then
+- This script has changed since then"""
+    if not ctx.args.build_off:
+        return True
+    if not entry:
+        return True
+    if entry['jprep'] != jprep_id() or entry['options'] != ctx.options_hash():
+        return True
+    for (name, seen) in entry['deps'].items():
+        if variant.observe(name) != seen:
+            return True
+    if not matches_record(in_path, entry['input']):
+        return True
+    if not matches_record(out_path, entry['output']):
+        return True
+    if ctx.args.source_maps and not os.path.isfile(out_path + '.map'):
+        return True
+    return False
+
+class PreprocessException(Exception):
+    """An exception thrown by preprocess which indicates a parse error that should be reported"""
+    def __init__(self, message, local_vars):
+        self.message = message
+        # the location is recorded now, since the parse may carry on for other configurations
+        if local_vars.scan == 0:
+            self.line_num = local_vars.prev_line_num
+            self.line = local_vars.prev_line
+        else:
+            self.line_num = local_vars.line_num
+            self.line = local_vars.in_line
+    def __str__(self):
+        return f'{self.message}\nLine {self.line_num}: {self.line}'
+    __repr__ = __str__
+
+class DefinitionEntry:
+    """Holds the value and possible choices for a defined name"""
+    __slots__ = ('value', 'choices', 'choice_set')
+
+    def __init__(self, value, choices):
+        self.value = value
+        # the choices are kept in order for error messages and snapshots, and as a set for
+        # checking conditions against
+        self.choices = choices
+        self.choice_set = frozenset(choices) if choices else None
+
+class IfState(Enum):
+    If = auto()
+    ElseIf = auto()
+    Else = auto()
+
+class IfEntry:
+    """Holds info about the current if directives"""
+    __slots__ = ('state', 'seen_true', 'in_true', 'scope_depth')
+
+    def __init__(self, scope_depth):
+        self.state = IfState.If
+        self.seen_true = False
+        self.in_true = False
+        self.scope_depth = scope_depth
+
+class ParsingEnvironment:
+    """Holds all definitions in a stack of scopes, and keeps track of nested if directives.
+Rather than keeping a dict per scope, each name maps to a stack of its definitions
+(paired with the depth of the scope they are in), and each scope only keeps a log of
+the names defined in it, so that they can be removed when it is left. This makes
+entering and leaving a scope, defining, and looking up all take constant time.
+Conditions are evaluated through a cache, which is cleared whenever a definition is
+added or removed."""
+
+    def push_scope(self):
+        """Enter a new scope"""
+        self.scope_starts.append(len(self.scope_log))
+
+    def pop_scope(self, ends_branch=False):
+        """Leave the current scope"""
+        depth = self.get_scope_depth()
+        if ((not ends_branch
+            and self.in_if()
+            and depth <= self.get_if_starting_scope_depth())
+        or depth <= self.base_depth):
+            raise PreprocessException('Attempted to leave final scope.', self.l)
+        start = self.scope_starts.pop()
+        if start == len(self.scope_log):
+            return
+        bindings = self.bindings
+        for name in self.scope_log[start:]:
+            stack = bindings[name]
+            stack.pop()
+            if not stack:
+                del bindings[name]
+        del self.scope_log[start:]
+        self.version += 1
+
+    def define(self, name, value=None, choices=None):
+        """Adds or overwrites the definition of name in the current scope"""
+        depth = self.get_scope_depth() - 1
+        entry = DefinitionEntry(value, choices)
+        self.version += 1
+        stack = self.bindings.get(name)
+        if stack is None:
+            self.bindings[name] = [(depth, entry)]
+        elif stack[-1][0] == depth:
+            stack[-1] = (depth, entry)
+            return
+        else:
+            stack.append((depth, entry))
+        self.scope_log.append(name)
+
+    def undefine(self, name):
+        """Removes a definition of name from the current scope"""
+        stack = self.bindings.get(name)
+        if not stack or stack[-1][0] != self.get_scope_depth() - 1:
+            raise PreprocessException(f'Cannot undefine "{name}"; it does not exist in the current scope.', self.l)
+        stack.pop()
+        if not stack:
+            del self.bindings[name]
+        self.version += 1
+        # keep the log in the order the names were defined in, as a dict would
+        log = self.scope_log
+        start = self.scope_starts[-1] if self.scope_starts else 0
+        del log[log.index(name, start)]
+
+    def lookup(self, name):
+        """Gets the entry for the most deeply nested definition of name, if there are any.
+If the result came from the base environment (or there was none), it is recorded in observed."""
+        stack = self.bindings.get(name)
+        if stack:
+            return stack[-1][1]
+        entry = self.base and self.base.find(name)
+        self.observed[name] = entry and [entry.value, entry.choices]
+        return entry
+
+    def evaluate(self, name, value):
+        """Evaluates a condition on name (testing it against value, unless that is None).
+Returns None if name is not defined, and otherwise (entry, in_choices, result): the entry for
+name, whether value is one of its choices (which it always is if it has none), and whether its
+value is value. Looks name up as lookup does the first time it is evaluated."""
+        cache = self.condition_cache
+        if self.cache_version != self.version:
+            cache.clear()
+            self.cache_version = self.version
+        key = (name, value)
+        if key in cache:
+            return cache[key]
+        entry = self.lookup(name)
+        if entry is None:
+            result = None
+        else:
+            # a missing value is never one of the choices
+            result = (entry, entry.choice_set is None or value in entry.choice_set, entry.value == value)
+        cache[key] = result
+        return result
+
+    def find(self, name):
+        """Gets the entry for the most deeply nested definition of name, without recording it"""
+        stack = self.bindings.get(name)
+        if stack:
+            return stack[-1][1]
+        return self.base and self.base.find(name)
+
+    def global_definitions(self):
+        """The (name, entry) pairs defined in the outermost scope, in the order they were defined"""
+        end = self.scope_starts[0] if self.scope_starts else len(self.scope_log)
+        return [(name, self.bindings[name][0][1]) for name in self.scope_log[:end]]
+
+    def get_scope_depth(self):
+        return self.base_scope_depth + len(self.scope_starts) + 1
+
+    def snapshot(self):
+        """All definitions, as a list of [name, value, choices] for each scope from the outermost,
+in the order they were defined; only meaningful outside of any if directive"""
+        ends = self.scope_starts + [len(self.scope_log)]
+        scopes = []
+        start = 0
+        for (depth, end) in enumerate(ends, self.base_scope_depth):
+            scope = []
+            for name in self.scope_log[start:end]:
+                entry = next(entry for (d, entry) in self.bindings[name] if d == depth)
+                scope.append([name, entry.value, entry.choices])
+            scopes.append(scope)
+            start = end
+        return scopes
+
+    @classmethod
+    def from_snapshot(cls, scopes):
+        """Creates an environment with the definitions in scopes, as returned by snapshot"""
+        result = cls()
+        for (i, scope) in enumerate(scopes):
+            if i:
+                result.push_scope()
+            for (name, value, choices) in scope:
+                result.define(name, value, choices)
+        return result
+
+    def get_if_depth(self):
+        return len(self.if_stack)
+
+    def push_if(self):
+        """Enter a new if directive"""
+        self.if_stack.append(IfEntry(self.get_scope_depth()))
+        self.false_branches += 1
+
+    def pop_if(self):
+        """Leave the current if directive"""
+        if not self.if_stack.pop().in_true:
+            self.false_branches -= 1
+
+    def in_if(self):
+        return bool(self.if_stack)
+
+    def set_if_branch(self, flag):
+        """Set the current if directive's truthfulness"""
+        entry = self.if_stack[-1]
+        if entry.in_true != flag:
+            self.false_branches += -1 if flag else 1
+        entry.in_true = flag
+        entry.seen_true |= flag
+
+    def set_if_state(self, state):
+        self.if_stack[-1].state = state
+
+    def get_if_state(self):
+        return self.if_stack[-1].state
+
+    def get_seen_true(self):
+        return self.if_stack[-1].seen_true
+
+    def get_in_true(self):
+        return self.false_branches == 0
+
+    def get_if_starting_scope_depth(self):
+        return self.if_stack[-1].scope_depth
+
+    def __init__(self):
+        # name -> stack of (scope depth, DefinitionEntry) for each of its definitions
+        self.bindings = {}
+        # the names defined in each scope, in order; each scope after the first starts
+        # at the matching index in scope_starts
+        self.scope_log = []
+        self.scope_starts = []
+        self.if_stack = []
+        # how many entries of if_stack are not in a true branch
+        self.false_branches = 0
+        # the environment this one was created on top of, if any, and how many scopes it has
+        self.base = None
+        self.base_scope_depth = 0
+        # scopes at or below this depth can never be left
+        self.base_depth = 1
+        # everything that was looked up in the base environment, and what was seen
+        # (as [value, choices], or None if it was not defined)
+        self.observed = {}
+        # counts changes to the definitions, so that condition_cache (which maps the
+        # (name, value) of each condition evaluated to its result) can be cleared when
+        # cache_version falls behind. The base environment never changes while this one is used.
+        self.version = 0
+        self.condition_cache = {}
+        self.cache_version = 0
+        self.l = None
+
+    @classmethod
+    def from_base_env(cls, env):
+        """Creates an environment which can see all definitions in env, and has a new
+scope of its own on top of them, so that nothing it defines or undefines leaks into env"""
+        result = cls()
+        result.base = env
+        result.base_scope_depth = env.get_scope_depth()
+        result.base_depth = result.base_scope_depth + 1
+        return result
+
+    def __getstate__(self):
+        # the parser's local variables are only meaningful during a parse
+        state = self.__dict__.copy()
+        state['l'] = None
+        return state
+
+# precompiled regexes
+whitespace_re = re.compile(r'(?!\s)')
+non_whitespace_re = re.compile(r'\S')
+identifier_re = re.compile(ID_CH + '+' + r'(?!' + ID_CH + ')')
+string_re = {}
+string_re["'"] = re.compile(r"(?<!\\)'")
+string_re['"'] = re.compile(r'(?<!\\)"')
+end_comment_re = re.compile(r'\*/')
+template_literal_re = re.compile(r'(?<!\\)`|(?<!\\)\$\{')
+main_loop_re = re.compile(r'/\*\$|"|\'|//|/\*|\{|\}|`')
+# matches the first character of everything main_loop_re matches, without consuming any more,
+# so that it finds every position main_loop_re could match at, even where those overlap
+token_start_re = re.compile(r'[{}"\'`]|/(?=[*/])')
+
+
+def choice_inclusion_error(name, value, choices):
+    choices_format = ", ".join(map(lambda c: f'"{c}"', choices))
+    return f'"{value}" is not one of the required choices for "{name}": [{choices_format}]'
+
+def check_definition(env, name, value, choices, strict_define=False):
+    """Checks whether name can be defined in env with value and choices, just as a define
+directive would. Returns a pair of the error message, if it cannot be (otherwise None),
+and the choices the definition ends up with."""
+    if strict_define and not value:
+        return ('definitions must set a value when using --strict_define', choices)
+
+    old_definition = env.lookup(name)
+    if old_definition:
+        if old_definition.choices:
+            if choices:
+                return (f'"{name}" already has a set of choices.', choices)
+            else:
+                choices = old_definition.choices
+
+    if choices:
+        if not value:
+            return ('A value must be given for a definition with choices.', choices)
+        if value not in choices:
+            return (choice_inclusion_error(name, value, choices), choices)
+    return (None, choices)
+
+def same_text(s1, s2):
+    """True if both strings are the same, ignoring case."""
+    # note, unicodedata.normalize is a good idea to get this to work all the time,
+    # but this is only used here to compare against our simple directive names
+    return s1.casefold() == s2.casefold()
+
+class ParseMode(Enum):
+    Output = auto()
+    Skip = auto()
+
+class OutputLane:
+    """The part of the parse state that belongs to a single configuration: its
+definitions, whether it is currently outputting or skipping code, and its
+partial output for the current line. When a file is preprocessed under several
+configurations at once, it is scanned only once, and each directive is parsed
+only once, but every lane evaluates the directives for itself."""
+    __slots__ = (
+        'env', 'out_file', 'out', 'parse_mode', 'mode_stack', 'branch_mode', 'emit', 'out_line',
+        'held', 'line_visible', 'line_skipped', 'error', 'skips', 'skip_from', 'source_map', 'out_marks')
+
+    def __init__(self, env, out_file):
+        self.env = env
+        self.out_file = out_file
+        # output waiting to be written to out_file, which happens once per chunk of input
+        self.out = []
+        self.parse_mode = ParseMode.Output
+        self.mode_stack = []
+        # the mode to switch to after the directive being parsed, if it starts a new branch
+        self.branch_mode = None
+        # all characters in in_line before emit have been added to out_line or have been skipped
+        self.emit = 0
+        # holds any partial line output as a list of (start, end) spans of in_line. This is only
+        # added to if part of the line is skipped; if emit is 0 at the end of a line, in_line can
+        # be output as it is
+        self.out_line = []
+        # when in_line is only a piece of a line that is too long to read whole, the
+        # (text, column) pieces of output from the line that are being held back, whether
+        # anything other than whitespace has been output from it, and whether anything in it
+        # was skipped
+        self.held = []
+        self.line_visible = False
+        self.line_skipped = False
+        # the error that stopped this lane, if any
+        self.error = None
+        # when replaying a DirectiveIndex, the (start, end, consumed newlines) spans of the
+        # input that are skipped, and where the current run of skipped code started
+        self.skips = []
+        self.skip_from = None
+        # the SourceMap being built of this lane's output, if any, and for each piece of out
+        # that came from the input, its (index in out, line, column)
+        self.source_map = None
+        self.out_marks = []
+
+    def push_mode(self, mode):
+        self.mode_stack.append(self.parse_mode)
+        self.parse_mode = mode
+
+    def pop_mode(self):
+        self.parse_mode = self.mode_stack.pop()
+
+class DirectiveIndex:
+    """Everything about a source file that does not depend on the configuration, so that
+it can be preprocessed again without scanning it. This is a list of ops, in the order
+they happen in the file:
+  ['scope', pops, pushes]: braces between directives, reduced to how many scopes
+    are left and then how many are entered
+  ['<', start]: a directive starts at character offset start
+  ['>', end, consumed]: the directive ends at offset end; consumed lists the offsets
+    of the newlines inside it that were skipped along with it
+  [kind, line_num, ...]: what a directive means (a define, an if, etc.), already parsed,
+    where line_num is the line any error in it is reported on
+An index is only complete if the scan reached the end of the file; one that was cut
+short by an error in the file is never replayed."""
+    def __init__(self, ops=None):
+        self.ops = [] if ops is None else ops
+        self.complete = ops is not None
+        self.consumed = []
+        self.pops = 0
+        self.pushes = 0
+
+    def push_scope(self):
+        self.pushes += 1
+
+    def pop_scope(self):
+        if self.pushes:
+            self.pushes -= 1
+        else:
+            self.pops += 1
+
+    def add(self, op):
+        if self.pops or self.pushes:
+            self.ops.append(['scope', self.pops, self.pushes])
+            self.pops = 0
+            self.pushes = 0
+        self.ops.append(op)
+
+# characters that can be part of a token of more than one character (or of an escape, or a
+# line ending); a line that is too long to read whole is never split next to one of these
+SPLIT_AVOIDED_CHARS = '/*${\\\r'
+
+def split_point(text, start=0, in_directive=False):
+    """The position nearest the end of text (and not before start) at which it can be split into
+pieces that scan the same as the whole, or 0 if there is none. The split is never next to a
+character in SPLIT_AVOIDED_CHARS, nor inside anything that looks like a directive (including
+one that text starts in the middle of, if in_directive is true)."""
+    p = len(text) - 1
+    while p > max(start, 0):
+        if text[p - 1] in SPLIT_AVOIDED_CHARS or text[p] in SPLIT_AVOIDED_CHARS:
+            p -= 1
+            continue
+        directive = text.rfind('/*$', 0, p)
+        if directive < 0 and in_directive:
+            directive = -3
+        if directive != -1 and text.find('*/', directive + 3, p) < 0:
+            p = directive
+            continue
+        return p
+    return 0
+
+def content_end(line):
+    """Position of the end of line, not counting its line ending"""
+    if line.endswith('\n'):
+        return len(line) - (2 if line.endswith('\r\n') else 1)
+    return len(line)
+
+def do_preprocess(in_file, out_file, env, strict_define=False, buffer_size=None):
+    """Preprocesses in_file into out_file, starting from the definitions in env.
+Raises a PreprocessException if the input has an error."""
+    [error] = do_preprocess_many(in_file, [(out_file, env)], strict_define, buffer_size=buffer_size)
+    if error:
+        raise error
+
+def do_preprocess_many(
+        in_file, targets, strict_define=False, index=None, stats=None, source_maps=None,
+        buffer_size=None, warn=None, _token_index=False):
+    """Preprocesses in_file once for each (out_file, env) pair in targets, while
+only reading and scanning it once.
+If index is a complete DirectiveIndex of in_file, it is replayed instead of
+scanning in_file; if it is a new, empty DirectiveIndex, it is filled in during the scan.
+If stats is a FileStats, the directives are counted and timed in it.
+If source_maps is given, it holds a SourceMap for each target (or None), in which a
+map of that target's output is built as it is written.
+The input is read buffer_size characters at a time (CHUNK_SIZE if it is None). A line longer
+than that is split into pieces that are scanned one after another, so that memory use does not
+grow with the length of lines; if a line cannot be split (because it is inside a directive),
+warn is called with a message saying so, and the line is held in memory whole.
+_token_index is only for benchmarks/run.py, which compares the scanner with an alternative
+that it has not been faster than: if it is true, the start of every token is found for each
+chunk of the input in one pass, and the scanner steps through those instead of searching each line.
+Returns a list holding, for each target, either None if it succeeded, or the
+PreprocessException that stopped it. An error in how one configuration
+evaluates a directive only stops that target, but an error in the input itself
+stops all of them."""
+
+    # black python magic
+    # will make it so the print(l) prints all local variables
+    from itertools import chain
+    class Debug(type):
+      def __str__(self):
+        return '\n'.join(
+            ['preprocess local variables:'] + [
+            f'  {var} = {val!r}'
+            for (var, val)
+             in chain(self.__dict__.items(),
+                {'in_line[scan:]': self.in_line[self.scan:]}.items())
+             if not var.startswith('__')
+            ])
+      __repr__ = __str__
+
+    # This is a bit of an ugly trick to avoid putting 'nonlocal' in any nested functions
+    # that only write to these (which I find easy to forget, and hard to track down; not a good combination)
+    class LocalVariables(metaclass=Debug):
+        # holds the line that was most recently read from in_file
+        in_line = ''
+        # current line number in in_file; 1 based
+        line_num = 0
+        # all characters in in_line before scan have been parsed
+        scan = 0
+        # for error reporting...
+        prev_line = ''
+        prev_line_num = 0
+        # character offset of in_line in in_file
+        offset = 0
+        # position of the end of in_line, not counting its line ending
+        end = 0
+        # when a line is too long to read whole, in_line is only a piece of it: column is
+        # where in the line in_line starts, and continues is whether more of the line follows
+        column = 0
+        continues = False
+        # whether a directive is being parsed
+        in_directive = False
+        # with _token_index, where each token starts in the lines of the current chunk, counting
+        # from token_base, the offset in in_file of the first of those lines
+        token_positions = None
+        token_base = 0
+    l = LocalVariables
+
+    # the index being filled in by this scan, if any
+    recorder = index if index is not None and not index.complete else None
+    if buffer_size is None:
+        buffer_size = CHUNK_SIZE
+
+    lanes = [OutputLane(env, out_file) for (out_file, env) in targets]
+    for lane in lanes:
+        lane.env.l = l
+    # the lanes that have not been stopped by an error
+    live = list(lanes)
+    # the live lanes that are currently skipping their input
+    skipping = []
+
+    # holds the scope depth and if depth at each template level
+    template_literal_stack = []
+
+    def update_skipping():
+        skipping[:] = [lane for lane in live if lane.parse_mode == ParseMode.Skip]
+
+    def fail(lane, error):
+        lane.error = error
+        live.remove(lane)
+        if not live:
+            raise error
+        update_skipping()
+
+    def each_lane(action):
+        """Calls action on every live lane. An error raised by action only stops that lane."""
+        for lane in list(live):
+            try:
+                action(lane)
+            except PreprocessException as e:
+                fail(lane, e)
+
+    def any_env():
+        """The environment of any live lane; use only for things that are the same in all of them,
+such as scope and if depths"""
+        return live[0].env
+
+    #----------------------------------------------------------------------------------------------
+    # Handle input and output and line transitions
+    # The input is read in large chunks, and split into lines (on '\n' only, keeping each line's
+    # ending as it is). Output is collected per lane, and written out each time a chunk is read.
+    def flush_output():
+        for lane in live:
+            if lane.out:
+                lane.out_file.write(''.join(lane.out))
+                lane.out.clear()
+
+    def index_tokens(lines, base):
+        """Indexes the tokens in lines, which start at offset base in in_file; returns the offset they end at"""
+        from array import array
+        block = ''.join(lines)
+        l.token_positions = array('I', map(re.Match.start, token_start_re.finditer(block)))
+        l.token_base = base
+        return base + len(block)
+
+    def indexed_search(line, scan, match=main_loop_re.match):
+        """Like main_loop_re.search(line, scan) for in_line, but using the token index"""
+        positions = l.token_positions
+        line_start = l.offset - l.token_base
+        i = bisect_left(positions, line_start + scan)
+        if i < len(positions):
+            start = positions[i] - line_start
+            if start < len(line):
+                return match(line, start)
+        return None
+
+    # finds the next token the scanner stops at in the current line
+    if _token_index:
+        from bisect import bisect_left
+        search_token = indexed_search
+    else:
+        search_token = main_loop_re.search
+
+    def chunked_lines():
+        # pieces of a line that goes past the end of the chunks read so far, and their length
+        pieces = []
+        size = 0
+        # whether that line has been found to be too long, but impossible to split
+        unsplittable = False
+        # with _token_index, the number of characters in the lines yielded so far
+        indexed = 0
+        while True:
+            chunk = in_file.read(buffer_size)
+            flush_output()
+            if not chunk:
+                break
+            last_newline = chunk.rfind('\n')
+            if last_newline < 0:
+                pieces.append(chunk)
+                size += len(chunk)
+                if size >= buffer_size:
+                    # hand out as much of the line as can be split off, keeping the rest
+                    text = ''.join(pieces)
+                    split = split_point(text, size - len(chunk) - 1, l.in_directive)
+                    if split:
+                        pieces = [text[split:]]
+                        size = len(pieces[0])
+                        if _token_index:
+                            indexed = index_tokens([text[:split]], indexed)
+                        l.continues = True
+                        yield text[:split]
+                    else:
+                        pieces = [text]
+                        if not unsplittable and warn is not None:
+                            warn(f'Line {l.line_num} is over {size} characters long, and cannot be split '
+                                'where it is (such as inside a directive), so it is being held in memory whole.')
+                        unsplittable = True
+                continue
+            lines = io.StringIO(chunk[:last_newline + 1]).readlines()
+            if pieces:
+                pieces.append(lines[0])
+                lines[0] = ''.join(pieces)
+                pieces = []
+                size = 0
+                unsplittable = False
+            if _token_index:
+                indexed = index_tokens(lines, indexed)
+            l.continues = False
+            yield from lines
+            if last_newline + 1 < len(chunk):
+                pieces.append(chunk[last_newline + 1:])
+                size = len(pieces[0])
+        if pieces:
+            line = ''.join(pieces)
+            if _token_index:
+                index_tokens([line], indexed)
+            l.continues = False
+            yield line
+
+    line_source = chunked_lines()
+
+    def read_line():
+        l.prev_line = l.in_line
+        l.prev_line_num = l.line_num
+        l.offset += len(l.in_line)
+        if l.continues:
+            l.column += len(l.in_line)
+        else:
+            l.column = 0
+            l.line_num += 1
+        l.in_line = next(line_source, '')
+        l.scan = 0
+        l.end = content_end(l.in_line)
+        for lane in live:
+            if lane.emit:
+                lane.emit = 0
+                lane.out_line.clear()
+
+    def write_output():
+        if l.column or l.continues:
+            write_piece_output()
+            return
+        line = l.in_line
+        for lane in live:
+            if lane.emit == 0:
+                lane.out.append(line)
+            else:
+                spans = lane.out_line
+                spans.append((lane.emit, len(line)))
+                # a line that had anything skipped is dropped if only whitespace is left
+                for (start, end) in spans:
+                    if non_whitespace_re.search(line, start, end):
+                        lane.out += [line[start:end] for (start, end) in spans]
+                        break
+
+    def write_piece_output():
+        """write_output for when in_line is only a piece of a line. Whether a line that had
+anything skipped is dropped is only known once all of it has been seen, so the output of
+each lane is held back until something other than whitespace is output."""
+        line = l.in_line
+        line_num = l.line_num - 1
+        for lane in live:
+            # each piece of output, with its column in the line
+            if lane.emit == 0:
+                pieces = [(line, l.column)]
+            else:
+                lane.line_skipped = True
+                lane.out_line.append((lane.emit, len(line)))
+                pieces = [(line[start:end], l.column + start) for (start, end) in lane.out_line]
+            if not lane.line_visible and any(non_whitespace_re.search(piece) for (piece, _) in pieces):
+                lane.line_visible = True
+                pieces = lane.held + pieces
+                lane.held = []
+            if not lane.line_visible:
+                lane.held += pieces
+            else:
+                for (piece, column) in pieces:
+                    if lane.source_map is not None:
+                        lane.out_marks.append((len(lane.out), line_num, column))
+                    lane.out.append(piece)
+            if not l.continues:
+                # the end of the line
+                if not lane.line_skipped:
+                    for (piece, column) in lane.held:
+                        if lane.source_map is not None:
+                            lane.out_marks.append((len(lane.out), line_num, column))
+                        lane.out.append(piece)
+                lane.held = []
+                lane.line_visible = False
+                lane.line_skipped = False
+
+    def append_output(lane):
+        if l.scan > lane.emit:
+            lane.out_line.append((lane.emit, l.scan))
+        lane.emit = l.scan
+
+    def move_to_next_line_if_necessary():
+        if l.scan > len(l.in_line):
+            raise Exception('Internal error')
+        if l.scan >= l.end:
+            write_output()
+            read_line()
+
+    #----------------------------------------------------------------------------------------------
+    # Parsing utility
+    def parse_any(count=1):
+        for lane in skipping:
+            append_output(lane)
+            lane.emit = l.scan + count
+        l.scan += count
+        move_to_next_line_if_necessary()
+
+    def parse_line():
+        end = l.end
+        for lane in skipping:
+            lane.emit = end
+        l.scan = end
+        move_to_next_line_if_necessary()
+
+    # All matching is done in place on in_line starting from scan (never on a slice of it),
+    # so that very long lines, such as those in minified files, are still scanned in linear time.
+    def parse_until(regex):
+        """Parses up to and including the next match of regex, and returns the matched text
+(or None if the end of the file was reached first)"""
+        while l.in_line:
+            m = regex.search(l.in_line, l.scan)
+            if m:
+                parse_any(m.end(0) - l.scan)
+                return m[0]
+            parse_line()
+        return None
+
+    #----------------------------------------------------------------------------------------------
+    # Error reporting
+    def report_error(message):
+        raise PreprocessException(message, l)
+
+    def report_choice_inclusion_error(name, value, choices):
+        report_error(choice_inclusion_error(name, value, choices))
+
+    #----------------------------------------------------------------------------------------------
+    # Parsing atoms
+    def try_parse_chars(s):
+        if l.in_line.startswith(s, l.scan):
+            parse_any(len(s))
+            return True
+        return False
+
+    def parse_chars(s, error_message):
+        if not try_parse_chars(s):
+            report_error(error_message)
+
+    def try_parse_identifier():
+        m = identifier_re.match(l.in_line, l.scan)
+        if not m:
+            return None
+        parse_any(m.end(0) - l.scan)
+        return m[0]
+
+    def parse_identifier(error_message):
+        result = try_parse_identifier()
+        if not result:
+            report_error(error_message)
+        return result
+
+    def parse_whitespace():
+        if recorder is not None:
+            # whitespace is the only thing in a directive that can skip the newline at the end of a line
+            if l.in_line.endswith('\n') and whitespace_re.search(l.in_line, l.scan).end(0) == len(l.in_line):
+                recorder.consumed.append(l.offset + len(l.in_line) - 1)
+        parse_until(whitespace_re)
+
+    def parse_string(quote):
+        parse_any(1)
+        parse_until(string_re[quote])
+
+    def parse_line_comment():
+        parse_line()
+        # the rest of a line that was too long to read whole
+        while l.column and l.in_line:
+            parse_line()
+
+    def parse_block_comment():
+        parse_until(end_comment_re)
+
+    def parse_template_literal():
+        parse_any(1)
+        if parse_until(template_literal_re) == '${':
+            env = any_env()
+            template_literal_stack.append([env.get_scope_depth(), env.get_if_depth()])
+
+    #----------------------------------------------------------------------------------------------
+    # Parsing directives
+    # The text of each directive is parsed once into an op; what the op means is then worked out
+    # in each lane. Ops are also what a DirectiveIndex holds, so the same code runs when one is replayed.
+    def location():
+        """The line number a PreprocessException raised now would report"""
+        return l.prev_line_num if l.scan == 0 else l.line_num
+
+    def run_op(op):
+        if recorder is not None:
+            recorder.add(op)
+        op_handlers[op[0]](*op[2:])
+
+    def parse_note():
+        parse_until(end_comment_re)
+
+    def parse_define():
+        name = parse_identifier('Expected a name at the beginning of the "define" directive.')
+        parse_whitespace()
+        value = None
+        choices = None
+        if try_parse_chars('='):
+            parse_whitespace()
+            value = parse_identifier('Expected a value after "=" in the "define" directive.')
+            parse_whitespace()
+        if try_parse_chars('<'):
+            choices = []
+            while True:
+                parse_whitespace()
+                choice = try_parse_identifier()
+                if choice:
+                    choices.append(choice)
+                elif not choices:
+                    report_error('There must be at least one choice after "<" in the "define" directive.')
+                parse_whitespace()
+                if not try_parse_chars(','):
+                    break
+
+        parse_whitespace()
+        if not try_parse_chars('*/'):
+            report_error('Only whitespace allowed at the end of a "define" directive.')
+        run_op(['define', location(), name, value, choices])
+
+    def apply_define(name, value, choices):
+        def define(lane):
+            env = lane.env
+            (error, lane_choices) = check_definition(env, name, value, choices, strict_define)
+            if error:
+                report_error(error)
+            env.define(name, value, lane_choices)
+        each_lane(define)
+
+    def parse_undefine():
+        name = parse_identifier('Expected a name at the beginning of the "undefine" directive.')
+        parse_whitespace()
+        if not try_parse_chars('*/'):
+            report_error('Only whitespace allowed at the end of a "undefine" directive.')
+        run_op(['undefine', location(), name])
+
+    def apply_undefine(name):
+        each_lane(lambda lane: lane.env.undefine(name))
+
+    def parse_condition(directive):
+        name = parse_identifier(f'Expected a name at the beginning of the "{directive}" directive.')
+        parse_whitespace()
+        value = None
+        if try_parse_chars('='):
+            parse_whitespace()
+            value = parse_identifier(f'Expected a value after "=" in the "{directive}" directive.')
+            parse_whitespace()
+        if not try_parse_chars('*/'):
+            report_error(f'Only whitespace allowed at the end of a "{directive}" directive.')
+        return [name, value]
+
+    def check_in_if(directive, after_else_allowed=False):
+        run_op(['check', location(), directive, after_else_allowed])
+
+    def apply_check(directive, after_else_allowed):
+        def check(lane):
+            env = lane.env
+            if not env.in_if():
+                report_error(f'"{directive}" directive outside of "if".')
+            if env.get_scope_depth() != env.get_if_starting_scope_depth():
+                report_error('if branches must have the same scopes at the start and end.')
+            if not after_else_allowed and env.get_if_state() == IfState.Else:
+                report_error(f'"{directive}" directive after "else".')
+        each_lane(check)
+
+    def set_branch_mode(lane):
+        if lane.env.get_in_true():
+            lane.branch_mode = ParseMode.Output
+        else:
+            lane.branch_mode = ParseMode.Skip
+
+    def parse_if():
+        [name, value] = parse_condition('if')
+        run_op(['if', location(), name, value])
+
+    def apply_if(name, value):
+        def enter_if(lane):
+            env = lane.env
+            evaluation = env.evaluate(name, value)
+            env.push_scope()
+            env.push_if()
+            if evaluation is None:
+                if strict_define:
+                    report_error('condition value must be defined when using --strict_define')
+                env.set_if_branch(False)
+            else:
+                if strict_define and not value:
+                    report_error('condtion must test against a value when using --strict_define')
+                (definition, in_choices, result) = evaluation
+                if not in_choices:
+                    report_choice_inclusion_error(name, value, definition.choices)
+                env.set_if_branch(result)
+            set_branch_mode(lane)
+        each_lane(enter_if)
+
+    def parse_elseif():
+        check_in_if('elseif')
+        [name, value] = parse_condition('elseif')
+        run_op(['elseif', location(), name, value])
+
+    def apply_elseif(name, value):
+        def enter_elseif(lane):
+            env = lane.env
+            lane.pop_mode()
+            evaluation = env.evaluate(name, value)
+            env.set_if_state(IfState.ElseIf)
+            env.pop_scope(True)
+            env.push_scope()
+            if evaluation is None:
+                env.set_if_branch(False)
+            else:
+                (definition, in_choices, result) = evaluation
+                if not in_choices:
+                    report_choice_inclusion_error(name, value, definition.choices)
+                env.set_if_branch(result and not env.get_seen_true())
+            set_branch_mode(lane)
+        each_lane(enter_elseif)
+
+    def parse_else():
+        check_in_if('else')
+        parse_whitespace()
+        if not try_parse_chars('*/'):
+            report_error('Only whitespace allowed at the end of a "else" directive.')
+        run_op(['else', location()])
+
+    def apply_else():
+        def enter_else(lane):
+            env = lane.env
+            lane.pop_mode()
+            env.set_if_state(IfState.Else)
+            env.pop_scope(True)
+            env.push_scope()
+            env.set_if_branch(not env.get_seen_true())
+            set_branch_mode(lane)
+        each_lane(enter_else)
+
+    def parse_fi():
+        check_in_if('fi', after_else_allowed=True)
+        parse_whitespace()
+        if not try_parse_chars('*/'):
+            report_error('Only whitespace allowed at the end of a "fi" directive.')
+        run_op(['fi', location()])
+
+    def apply_fi():
+        def leave_if(lane):
+            env = lane.env
+            lane.pop_mode()
+            env.pop_if()
+            env.pop_scope(True)
+        each_lane(leave_if)
+
+    def apply_end_of_file():
+        def check_end_of_file(lane):
+            if lane.env.in_if():
+                report_error('Reached the end of the file in the middle of an if directive branches.')
+        each_lane(check_end_of_file)
+
+    op_handlers = {
+        'define': apply_define,
+        'undefine': apply_undefine,
+        'check': apply_check,
+        'if': apply_if,
+        'elseif': apply_elseif,
+        'else': apply_else,
+        'fi': apply_fi,
+        'eof': apply_end_of_file,
+        }
+
+    def start_directive():
+        # the directive itself is skipped in every lane
+        for lane in live:
+            lane.push_mode(ParseMode.Skip)
+            lane.branch_mode = None
+        update_skipping()
+
+    def end_directive():
+        for lane in live:
+            lane.pop_mode()
+            if lane.branch_mode:
+                lane.push_mode(lane.branch_mode)
+        update_skipping()
+
+    def parse_directive():
+        if recorder is not None:
+            recorder.add(['<', l.offset + l.scan])
+            recorder.consumed = []
+        start_directive()
+        l.in_directive = True
+        parse_any(3)
+        parse_whitespace()
+        directive = parse_identifier('Directives must start with an identifier.')
+        parse_whitespace()
+
+        if same_text(directive, 'note'):
+            parse_note()
+        elif same_text(directive, 'define'):
+            parse_define()
+        elif same_text(directive, 'undefine'):
+            parse_undefine()
+        elif same_text(directive, 'if'):
+            parse_if()
+        elif same_text(directive, 'elseif'):
+            parse_elseif()
+        elif same_text(directive, 'else'):
+            parse_else()
+        elif same_text(directive, 'fi'):
+            parse_fi()
+        else:
+            report_error(f'"{directive}"" is not a recognized directive.')
+
+        if recorder is not None:
+            recorder.add(['>', l.offset + l.scan, recorder.consumed])
+        l.in_directive = False
+        end_directive()
+
+    def handle_close_brace():
+        env = any_env()
+        if template_literal_stack and (template_literal_stack[-1][0] == env.get_scope_depth()):
+            if env.in_if() and (env.get_if_depth() != template_literal_stack[-1][1]):
+                report_error('Reached the end of a template expression in the middle of an if directive branch.')
+            template_literal_stack.pop()
+            parse_template_literal()
+        else:
+            each_lane(lambda lane: lane.env.pop_scope())
+            if recorder is not None:
+                recorder.pop_scope()
+            parse_any(1)
+
+
+    #----------------------------------------------------------------------------------------------
+    # Skipping code in false branches
+    def skip_ahead():
+        """Scans forward while every live lane is skipping, up to the next directive (or the end
+of the file). Nothing that is skipped is output, so this only finds where strings, comments
+and template literals end, and counts braces without telling the lanes about each one; they
+are brought up to date with the number of scopes left and then entered when this returns.
+Lines that are skipped as a whole never go through the usual line handling; only blank ones
+are output. Anything uncommon (a string, comment or template literal that goes past the end
+of its line, or a brace that would be an error) is left for the usual parsing code."""
+        env = any_env()
+        # a brace at this depth would leave the if directive's scope, which is an error
+        floor = max(env.get_if_starting_scope_depth(), env.base_depth)
+        if_depth = env.get_if_depth()
+        depth = env.get_scope_depth()
+        pops = 0
+        pushes = 0
+        line = l.in_line
+        scan = l.scan
+        # after the first line, only whole lines are scanned here, and l is not kept up to date
+        whole_lines = False
+
+        def catch_up(scan):
+            if whole_lines:
+                l.column = 0
+                l.in_line = line
+                l.prev_line_num = l.line_num - 1
+                l.end = content_end(line)
+            l.scan = scan
+            for lane in live:
+                lane_env = lane.env
+                for _ in range(pops):
+                    lane_env.pop_scope()
+                for _ in range(pushes):
+                    lane_env.push_scope()
+            if recorder is not None:
+                for _ in range(pops):
+                    recorder.pop_scope()
+                for _ in range(pushes):
+                    recorder.push_scope()
+            for lane in skipping:
+                lane.emit = scan
+
+        while line:
+            m = search_token(line, scan)
+            if m:
+                token = m[0]
+                start = m.start(0)
+                if token == '{':
+                    pushes += 1
+                    scan = start + 1
+                    continue
+                elif token == '}':
+                    current = depth - pops + pushes
+                    if template_literal_stack and template_literal_stack[-1][0] == current:
+                        # the end of a template expression
+                        end = template_literal_re.search(line, start + 1)
+                        if not end or template_literal_stack[-1][1] != if_depth:
+                            catch_up(start)
+                            return
+                        template_literal_stack.pop()
+                        if end[0] == '${':
+                            template_literal_stack.append([current, if_depth])
+                        scan = end.end(0)
+                        continue
+                    if current <= floor:
+                        catch_up(start)
+                        return
+                    if pushes:
+                        pushes -= 1
+                    else:
+                        pops += 1
+                    scan = start + 1
+                    continue
+                elif token != '//':
+                    if token == '/*':
+                        # just like parse_block_comment, which allows the '*' of '/*' to be part of '*/'
+                        end = end_comment_re.search(line, start + 1)
+                    elif token == '`':
+                        end = template_literal_re.search(line, start + 1)
+                        if end and end[0] == '${':
+                            template_literal_stack.append([depth - pops + pushes, if_depth])
+                    elif token == '/*$':
+                        end = None
+                    else:
+                        end = string_re[token].search(line, start + 1)
+                    if not end:
+                        catch_up(start)
+                        return
+                    scan = end.end(0)
+                    continue
+            # the rest of the line is skipped
+            if whole_lines:
+                if line == '\n' or line == '\r\n':
+                    for lane in live:
+                        lane.out.append(line)
+                l.prev_line = line
+                l.offset += len(line)
+                l.line_num += 1
+                line = next(line_source, '')
+                if l.continues:
+                    # the start of a line too long to read whole, which is left to the usual line handling
+                    catch_up(0)
+                    return
+            else:
+                l.scan = scan
+                if m:
+                    parse_line_comment()
+                else:
+                    parse_line()
+                line = l.in_line
+                if l.column or l.continues:
+                    catch_up(0)
+                    return
+                whole_lines = True
+            scan = 0
+        catch_up(0)
+
+    def parse_file():
+        while l.in_line:
+            if skipping and len(skipping) == len(live):
+                skip_ahead()
+                if not l.in_line:
+                    break
+            m = search_token(l.in_line, l.scan)
+            if m:
+                parse_any(m.start(0) - l.scan)
+                if m[0] in ["'", '"']:
+                    parse_string(m[0])
+                elif m[0] == '`':
+                    parse_template_literal()
+                elif m[0] == '//':
+                    parse_line_comment()
+                elif m[0] == '/*':
+                    parse_block_comment()
+                elif m[0] == '{':
+                    for lane in live:
+                        lane.env.push_scope()
+                    if recorder is not None:
+                        recorder.push_scope()
+                    parse_any(1)
+                elif m[0] == '}':
+                    handle_close_brace()
+                elif m[0] == '/*$':
+                    parse_directive()
+            else:
+                parse_line()
+
+    #----------------------------------------------------------------------------------------------
+    # Replaying a DirectiveIndex
+    # Instead of scanning, the ops are run as they were recorded, and each lane keeps track
+    # of the spans of the input it skips. Its output is then written from those as the input
+    # is read through once more, a chunk at a time.
+    def replay():
+        # errors are reported on the line recorded with each op; the text of that line
+        # is only looked up if there actually is an error
+        l.scan = 1
+        l.in_line = None
+        start = 0
+        for op in index.ops:
+            kind = op[0]
+            if kind == 'scope':
+                [_, pops, pushes] = op
+                for lane in live:
+                    env = lane.env
+                    for _ in range(pops):
+                        env.pop_scope()
+                    for _ in range(pushes):
+                        env.push_scope()
+            elif kind == '<':
+                start = op[1]
+                for lane in live:
+                    if lane.parse_mode == ParseMode.Skip:
+                        lane.skips.append((lane.skip_from, start, ()))
+                start_directive()
+            elif kind == '>':
+                [_, end, consumed] = op
+                for lane in live:
+                    lane.skips.append((start, end, consumed))
+                end_directive()
+                for lane in live:
+                    if lane.parse_mode == ParseMode.Skip:
+                        lane.skip_from = end
+            else:
+                l.line_num = op[1]
+                op_handlers[kind](*op[2:])
+        writers = []
+        for lane in live:
+            if lane.parse_mode == ParseMode.Skip:
+                lane.skips.append((lane.skip_from, None, ()))
+            writers.append(ReplayWriter(lane.out_file, lane.skips, lane.source_map))
+        base = 0
+        while True:
+            chunk = in_file.read(buffer_size)
+            if not chunk:
+                break
+            if chunk.endswith('\r'):
+                # keep '\r\n' line endings in one chunk
+                chunk += in_file.read(1)
+            for writer in writers:
+                writer.feed(chunk, base)
+            base += len(chunk)
+        for writer in writers:
+            writer.finish()
+
+    def fill_in_error_lines():
+        wanted = {lane.error.line_num for lane in lanes if lane.error is not None and lane.error.line is None}
+        if not wanted:
+            return
+        # the file is read through to the end (a chunk at a time), so that anything counting
+        # what is read, such as a TimedFile, sees all of it; only the start of a line too long
+        # to read whole is kept, as it would be when scanning
+        found = {}
+        in_file.seek(0)
+        line_num = 1
+        while True:
+            chunk = in_file.read(buffer_size)
+            if not chunk:
+                break
+            start = 0
+            while start < len(chunk):
+                newline = chunk.find('\n', start)
+                end = len(chunk) if newline < 0 else newline + 1
+                if line_num in wanted:
+                    line = found.get(line_num, '')
+                    found[line_num] = line + chunk[start:min(end, start + buffer_size - len(line))]
+                if newline < 0:
+                    break
+                line_num += 1
+                start = end
+        for lane in lanes:
+            e = lane.error
+            if e is not None and e.line is None:
+                e.line = found.get(e.line_num, '')
+
+    #----------------------------------------------------------------------------------------------
+    # Gathering statistics
+    # This is done by wrapping the functions that are measured, so that it costs nothing
+    # when there are no stats to gather.
+    if stats is not None:
+        plain_start_directive = start_directive
+        plain_end_directive = end_directive
+
+        def start_directive():
+            stats.start_directive(any_env())
+            plain_start_directive()
+
+        def end_directive():
+            plain_end_directive()
+            stats.end_directive()
+
+        def counted(kind, handler):
+            def counted_handler(*args):
+                stats.kind = kind
+                handler(*args)
+            return counted_handler
+
+        for kind in ['define', 'undefine', 'if', 'elseif', 'else', 'fi']:
+            op_handlers[kind] = counted(kind, op_handlers[kind])
+
+        # every scope entered in the file is entered in each lane's environment
+        def sampled(env, push_scope):
+            def sampled_push_scope():
+                push_scope()
+                stats.enter_scope(env)
+            return sampled_push_scope
+
+        for lane in lanes:
+            lane.env.push_scope = sampled(lane.env, lane.env.push_scope)
+
+    #----------------------------------------------------------------------------------------------
+    # Building source maps
+    # Like gathering statistics, this is done by wrapping the functions that produce output.
+    # Each piece of output that comes from the input is marked with the line and column it
+    # came from, and the marked output is passed on to each lane's SourceMap as it is flushed.
+    if source_maps is not None:
+        for (lane, source_map) in zip(lanes, source_maps):
+            lane.source_map = source_map
+        plain_flush_output = flush_output
+        plain_write_output = write_output
+
+        def flush_output():
+            for lane in live:
+                if lane.source_map is not None:
+                    map_output(lane)
+            plain_flush_output()
+
+        def map_output(lane):
+            marks = iter(lane.out_marks)
+            mark = next(marks, None)
+            for (i, piece) in enumerate(lane.out):
+                if mark is not None and mark[0] == i:
+                    lane.source_map.add(piece, mark[1], mark[2])
+                    mark = next(marks, None)
+                else:
+                    # blank lines left by skipped code
+                    lane.source_map.add(piece)
+            lane.out_marks.clear()
+
+        def write_output():
+            if l.column or l.continues:
+                # the pieces of a long line are marked as they are output
+                plain_write_output()
+                return
+            counts = [len(lane.out) for lane in live]
+            plain_write_output()
+            line = l.line_num - 1
+            for (lane, count) in zip(live, counts):
+                if len(lane.out) > count:
+                    if lane.emit == 0:
+                        lane.out_marks.append((count, line, 0))
+                    else:
+                        # each span of out_line was added to out as a piece of its own
+                        for (i, (start, _)) in enumerate(lane.out_line):
+                            lane.out_marks.append((count + i, line, start))
+
+    try:
+        if index is not None and index.complete:
+            try:
+                replay()
+            finally:
+                fill_in_error_lines()
+        else:
+            read_line()
+            parse_file()
+            run_op(['eof', location()])
+            flush_output()
+            if recorder is not None:
+                recorder.complete = True
+    except PreprocessException as e:
+        # an error in the input itself, which stops every lane that was still going
+        for lane in live:
+            lane.error = e
+    finally:
+        if stats is not None:
+            # the environments belong to the caller, so they are left as they were
+            for lane in lanes:
+                del lane.env.push_scope
+    return [lane.error for lane in lanes]
+
+class ReplayWriter:
+    """Writes a file to out_file without the (start, end, consumed) spans in skips, just as
+preprocessing would have, while the file is fed to it a chunk at a time: the line endings in
+a span are kept unless their offsets are in consumed, and a line that had anything skipped is
+dropped if only whitespace is left. The end of the last span can be None, for the end of the
+file. If source_map is given, the output is mapped in it as well."""
+    # number of pieces of output to collect before writing them out
+    BUFFER_SIZE = 1024
+
+    def __init__(self, out_file, skips, source_map=None):
+        self.out_file = out_file
+        self.skips = skips
+        self.source_map = source_map
+        # everything in the file before pos has been kept or skipped, and skips[next_skip]
+        # is the first span that does not end before pos
+        self.pos = 0
+        self.next_skip = 0
+        # the line pos is in, and the offset it starts at
+        self.line = 0
+        self.line_start = 0
+        # the (text, column) pieces of the current line that are being held back until it is
+        # known whether the line is dropped, whether anything other than whitespace has been
+        # kept in it (after which nothing is held back), and whether anything in it was skipped
+        self.held = []
+        self.line_visible = False
+        self.line_skipped = False
+        # output waiting to be written to out_file
+        self.out = []
+
+    def feed(self, text, base):
+        """Takes the next chunk of the file, text, which starts at offset base"""
+        text_end = base + len(text)
+        while self.pos < text_end:
+            if self.next_skip < len(self.skips):
+                (start, end, consumed) = self.skips[self.next_skip]
+                if end is not None and end <= self.pos:
+                    self.next_skip += 1
+                    continue
+            else:
+                (start, end, consumed) = (text_end, None, ())
+            if self.pos < start:
+                stop = min(start, text_end)
+                self.keep(text, self.pos - base, stop - base, base)
+            else:
+                stop = text_end if end is None else min(end, text_end)
+                self.skip(text, self.pos - base, stop - base, base, consumed)
+            self.pos = stop
+
+    def finish(self):
+        self.end_line(None)
+        self.out_file.write(''.join(self.out))
+        self.out.clear()
+
+    def write(self, piece, column):
+        self.out.append(piece)
+        if self.source_map is not None:
+            self.source_map.add(piece, self.line, column)
+        if len(self.out) >= self.BUFFER_SIZE:
+            self.out_file.write(''.join(self.out))
+            self.out.clear()
+
+    def add(self, piece, column):
+        """Keeps piece, which is part of the current line starting at column"""
+        if self.line_visible:
+            self.write(piece, column)
+        elif non_whitespace_re.search(piece):
+            self.line_visible = True
+            for (held_piece, held_column) in self.held:
+                self.write(held_piece, held_column)
+            self.held.clear()
+            self.write(piece, column)
+        else:
+            self.held.append((piece, column))
+
+    def end_line(self, next_line_start):
+        """Finishes the current line; the next one starts at next_line_start"""
+        if not self.line_skipped:
+            for (held_piece, held_column) in self.held:
+                self.write(held_piece, held_column)
+        self.held.clear()
+        self.line_visible = False
+        self.line_skipped = False
+        self.line += 1
+        self.line_start = next_line_start
+
+    def keep(self, text, start, end, base):
+        newline = text.find('\n', start, end)
+        if newline >= 0:
+            self.add(text[start:newline + 1], base + start - self.line_start)
+            self.end_line(base + newline + 1)
+            start = newline + 1
+            # whole lines in between have nothing skipped
+            last_newline = text.rfind('\n', start, end)
+            if last_newline >= 0:
+                self.write(text[start:last_newline + 1], 0)
+                self.line += text.count('\n', start, last_newline + 1)
+                start = last_newline + 1
+                self.line_start = base + start
+        if start < end:
+            self.add(text[start:end], base + start - self.line_start)
+
+    def skip(self, text, start, end, base, consumed):
+        while True:
+            newline = text.find('\n', start, end)
+            if newline < 0:
+                if start < end:
+                    self.line_skipped = True
+                return
+            if base + newline in consumed:
+                self.line_skipped = True
+            else:
+                # the line ending is kept, whether it is '\n' or '\r\n'
+                line_ending = newline - 1 if newline > start and text[newline - 1] == '\r' else newline
+                if line_ending > start:
+                    self.line_skipped = True
+                self.add(text[line_ending:newline + 1], base + line_ending - self.line_start)
+            self.end_line(base + newline + 1)
+            start = newline + 1
+
+#--------------------------------------------------------------------------------------------------
+# Source maps
+
+BASE64_DIGITS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+
+def vlq(value):
+    """value in the base 64 variable length encoding used by source maps"""
+    value = (-value << 1) | 1 if value < 0 else value << 1
+    digits = ''
+    while True:
+        digit = value & 31
+        value >>= 5
+        if value:
+            digits += BASE64_DIGITS[digit | 32]
+        else:
+            return digits + BASE64_DIGITS[digit]
+
+# matches each token that gets its own mapping with --source_map_columns
+token_re = re.compile(r'[\w$]+|[^\w$\s]+')
+id_ch_re = re.compile(ID_CH)
+
+class SourceMap:
+    """Writes a version 3 source map of an output to map_file while the output is being
+written. Its mappings are streamed out as they are made, so only a little of the map
+is ever held in memory. Without columns, each line of output is mapped to where its
+first non-whitespace character came from; with columns, each token in the output is mapped."""
+    # number of segments to collect before writing them out
+    BUFFER_SIZE = 1024
+
+    def __init__(self, map_file, in_path, out_path, columns=False):
+        self.map_file = map_file
+        self.columns = columns
+        map_dir = os.path.dirname(os.path.abspath(out_path))
+        source = os.path.relpath(os.path.abspath(in_path), map_dir).replace(os.sep, '/')
+        header = json.dumps({'version': 3, 'file': os.path.basename(out_path), 'sources': [source], 'names': []})
+        map_file.write(header[:-1] + ', "mappings": "')
+        self.buffer = []
+        # the column reached in the current line of output, and whether it has been mapped
+        self.out_column = 0
+        self.line_mapped = False
+        # the previous segment's fields, which the next segment is relative to
+        self.prev_out_column = 0
+        self.prev_line = 0
+        self.prev_column = 0
+        # with columns, where in the input the last piece ended, if it ended in a token, and
+        # that token's match in token_re, so that a token split between pieces is mapped once
+        self.token_end = None
+
+    def segment(self, out_column, line, column):
+        self.buffer.append(
+            (',' if self.line_mapped else '')
+            + vlq(out_column - self.prev_out_column)
+            + 'A'
+            + vlq(line - self.prev_line)
+            + vlq(column - self.prev_column))
+        self.line_mapped = True
+        self.prev_out_column = out_column
+        self.prev_line = line
+        self.prev_column = column
+
+    def add(self, text, line=None, column=0):
+        """Notes that text is the next piece of the output. If line is given, text is a
+copy of the input starting at that line and column (both 0 based)."""
+        start = 0
+        continued = self.token_end
+        self.token_end = None
+        while start < len(text):
+            newline = text.find('\n', start)
+            end = len(text) if newline < 0 else newline + 1
+            if line is not None:
+                if self.columns:
+                    for match in token_re.finditer(text, start, end):
+                        if match.start() == 0 and continued == (line, column, bool(id_ch_re.match(text))):
+                            # the rest of a token which was already mapped
+                            continue
+                        self.out_column += match.start() - start
+                        column += match.start() - start
+                        start = match.start()
+                        self.segment(self.out_column, line, column)
+                elif not self.line_mapped:
+                    piece = text[start:end]
+                    indent = len(piece) - len(piece.lstrip())
+                    if indent < len(piece):
+                        self.segment(self.out_column + indent, line, column + indent)
+            if newline < 0:
+                self.out_column += end - start
+                if line is not None and self.columns and not text[-1].isspace():
+                    self.token_end = (line, column + end - start, bool(id_ch_re.match(text, end - 1)))
+                break
+            self.buffer.append(';')
+            self.out_column = 0
+            self.line_mapped = False
+            self.prev_out_column = 0
+            if line is not None:
+                line += 1
+                column = 0
+            start = end
+        if len(self.buffer) >= self.BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.map_file.write(''.join(self.buffer))
+        self.buffer.clear()
+
+    def finish(self):
+        self.flush()
+        self.map_file.write('"}\n')
+
+def with_source_maps(process_func, in_path, out_paths, columns):
+    """Wraps process_func(in_file, out_files, source_maps) for atomic_streamed_multi_file_process,
+with the source map of each of out_paths written to the output after all of out_paths"""
+    def mapping_process_func(in_file, out_files):
+        count = len(out_paths)
+        source_maps = [
+            SourceMap(map_file, in_path, out_path, columns)
+            for (map_file, out_path)
+             in zip(out_files[count:], out_paths)
+            ]
+        successes = process_func(in_file, out_files[:count], source_maps)
+        for source_map in source_maps:
+            source_map.finish()
+        return successes * 2
+    return mapping_process_func
+
+def map_copy(in_file, map_file, in_path, out_path):
+    """Writes the source map of an output that is an exact copy of in_file to map_file,
+as a process_func for atomic_streamed_file_process"""
+    source_map = SourceMap(map_file, in_path, out_path)
+    # lines are only ended by '\n', as when scanning, so the file is not iterated by line
+    # (which with newline='' also ends them at a lone '\r')
+    line = 0
+    column = 0
+    while True:
+        text = in_file.read(CHUNK_SIZE)
+        if not text:
+            break
+        source_map.add(text, line, column)
+        newlines = text.count('\n')
+        line += newlines
+        column = len(text) - text.rfind('\n') - 1 if newlines else column + len(text)
+    source_map.finish()
+    return True
+
+def show_global_env(variant):
+    heading = f'Configuration for "{variant.out_dir}":' if variant.configuration else 'Configuration:'
+    return '\n'.join(
+        [heading] + [
+        f'  {name} = {entry.value}'
+        for (name, entry)
+         in variant.global_env.global_definitions()
+        ])
+
+def buffer_size(ctx):
+    """The number of characters of input to read at a time, from --buffer_size"""
+    size = getattr(ctx.args, 'buffer_size', None)
+    return size << 10 if size else None
+
+def preprocess(ctx, in_file, out_file, env):
+    """Preprocesses in_file into out_file starting from env, reporting any error to ctx.
+Returns whether it succeeded."""
+    try:
+        ctx.profiled(do_preprocess, in_file, out_file, env, ctx.args.strict_define, buffer_size(ctx))
+    except PreprocessException as e:
+        ctx.error(e)
+        return False
+    return True
+
+def preprocess_variants(ctx, in_file, out_files, variants, envs, index=None, stats=None, source_maps=None):
+    """Preprocesses in_file into each of out_files at once, starting from the matching
+env of envs, reporting any errors to ctx. Returns a list of which ones succeeded.
+index, stats and source_maps are passed on to do_preprocess_many."""
+    name = getattr(in_file, 'name', 'the input')
+    errors = ctx.profiled(
+        do_preprocess_many, in_file, list(zip(out_files, envs)), ctx.args.strict_define,
+        index, stats, source_maps, buffer_size(ctx), lambda message: ctx.log(LOG_INFO_LEVEL_NUM, f'In "{name}": {message}'))
+    messages = [error and str(error) for error in errors]
+    # an error every variant ran into is only reported once
+    if None not in messages and len(set(messages)) == 1:
+        ctx.error(messages[0])
+    else:
+        for (variant, message) in zip(variants, messages):
+            if message is not None:
+                ctx.error(f'In the variant for "{variant.out_dir}": {message}')
+    return [error is None for error in errors]
+
+class NullOut():
+    """An output file that discards everything written to it"""
+    def write(self, s):
+        pass
+
+def preprocess_config(ctx, config_path, env):
+    with open(config_path, 'r', newline='') as in_file:
+        return preprocess(ctx, in_file, NullOut(), env)
+
+def config_key(ctx, config_paths):
+    """The key of the ConfigSnapshot of the environment built from config_paths"""
+    key = [jprep_id(), ctx.args.strict_define] + [hash_file(path) for path in config_paths]
+    return hash_bytes(json.dumps(key).encode())
+
+def parse_define_option(text):
+    """Splits text of the form NAME[=VALUE] into [NAME, VALUE] (where VALUE may be None)"""
+    (name, equals, value) = text.partition('=')
+    return [name.strip(), value.strip() if equals else None]
+
+def read_defines_json(path):
+    """Reads the definitions in a --defines_json file, as a list of [name, value, choices].
+Raises a ValueError if the file is not in the right form."""
+    with open(path, 'r') as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError('it must hold a JSON object')
+    definitions = []
+    for (name, definition) in data.items():
+        if isinstance(definition, dict):
+            value = definition.get('value')
+            choices = definition.get('choices')
+        else:
+            value = definition
+            choices = None
+        if not (value is None or isinstance(value, str)):
+            raise ValueError(f'the value of "{name}" must be a string or null')
+        if not (choices is None or (isinstance(choices, list) and all(isinstance(choice, str) for choice in choices))):
+            raise ValueError(f'the choices of "{name}" must be a list of strings')
+        definitions.append([name, value, choices])
+    return definitions
+
+def command_line_defines(ctx):
+    """Gathers the definitions given outside of any configuration file: those in the
+environment variable, then in any --defines_json, then each -D, as a list of
+(where it came from, name, value, choices). Returns None if any of them cannot be read."""
+    defines = []
+    for text in os.environ.get(DEFINES_ENV_VAR, '').split():
+        defines.append((f'In {DEFINES_ENV_VAR}', *parse_define_option(text), None))
+    json_path = getattr(ctx.args, 'defines_json', None)
+    if json_path:
+        try:
+            defines += [(f'In "{json_path}"', *definition) for definition in read_defines_json(json_path)]
+        except (OSError, ValueError) as e:
+            ctx.error(f'Could not read the definitions in "{json_path}": {e}')
+            return None
+    for text in getattr(ctx.args, 'defines', None) or []:
+        defines.append((f'In "-D {text}"', *parse_define_option(text), None))
+    return defines
+
+def define_in_env(ctx, env, source, name, value, choices):
+    """Adds a definition from command_line_defines to env, checking it just as a define
+directive would. Returns whether it succeeded."""
+    identifiers = [name] + ([value] if value is not None else []) + (choices or [])
+    error = None
+    if not all(identifier_re.fullmatch(identifier) for identifier in identifiers):
+        error = 'names, values and choices must all be identifiers.'
+    elif choices == []:
+        error = 'There must be at least one choice.'
+    else:
+        (error, choices) = check_definition(env, name, value, choices, ctx.args.strict_define)
+    if error:
+        ctx.error(f'{source}: {error}')
+        return False
+    env.define(name, value, choices)
+    return True
+
+def load_configurations(ctx):
+    """Builds the environment of each variant from the configuration files, or loads it
+from the variant's snapshot if they have not changed since it was saved, and then adds
+the definitions given outside of any configuration file on top.
+If any of them has an error, the variants are left as they were.
+Returns whether it succeeded."""
+    defines = command_line_defines(ctx)
+    if defines is None:
+        return False
+    # when piped, there is no output directory to keep a snapshot in
+    use_snapshots = not (ctx.args.stdio or ctx.args.framed)
+    envs = []
+    for variant in ctx.variants:
+        config_paths = [path for path in [ctx.args.configuration, variant.configuration] if path]
+        env = None
+        if config_paths and use_snapshots:
+            key = config_key(ctx, config_paths)
+            env = variant.snapshot.load(key)
+            if env is not None:
+                ctx.verbose(f'Loaded the configuration for "{variant.out_dir}" from its snapshot.')
+        if env is None:
+            env = ParsingEnvironment()
+            for config_path in config_paths:
+                if not preprocess_config(ctx, config_path, env):
+                    return False
+            if config_paths and use_snapshots:
+                variant.snapshot.save(key, env)
+        for define in defines:
+            if not define_in_env(ctx, env, *define):
+                return False
+        envs.append(env)
+    for (variant, env) in zip(ctx.variants, envs):
+        variant.global_env = env
+    return True
+
+def validate(ctx, in_path):
+    """Parses the file at in_path without writing any output, to check it for errors"""
+    with open(in_path, 'r', newline='') as in_file:
+        return preprocess(ctx, in_file, NullOut(), ParsingEnvironment())
+
+def process_file(ctx, filename):
+    """Preprocesses a single file named on the command line for each variant that needs it.
+If fast copying is on, files with no directives are copied instead.
+Returns the file's new entry in the build manifest of each variant (None where it failed)."""
+    args = ctx.args
+    in_path = os.path.join(args.in_dir, filename)
+    entries = []
+    # the variants that need to be built, and where their entries go
+    pending = []
+    for variant in ctx.variants:
+        out_path = os.path.join(variant.out_dir, filename)
+        entry = copy.deepcopy(variant.manifest.get(filename)) if args.build_off else None
+        if should_preprocess(ctx, variant, entry, in_path, out_path):
+            pending.append((len(entries), variant, out_path))
+        entries.append(entry)
+    if not pending:
+        ctx.verbose(f'Skipping "{filename}"; it is already up-to-date.')
+        return entries
+
+    stats = FileStats(filename) if ctx.file_stats is not None else None
+    start = time.perf_counter()
+    input_record = file_record(in_path)
+    variants = [variant for (_, variant, _) in pending]
+    out_paths = [out_path for (_, _, out_path) in pending]
+    for out_path in out_paths:
+        ctx.make_dir(os.path.dirname(out_path))
+    envs = [ParsingEnvironment.from_base_env(variant.global_env) for variant in variants]
+    if args.fast_copy and not has_directives(in_path):
+        if args.validate and not validate(ctx, in_path):
+            successes = [False] * len(pending)
+        else:
+            for out_path in out_paths:
+                atomic_streamed_file_process(in_path, out_path, bulk_copy, binary=True, readonly=args.readonly, keep_unchanged=args.keep_unchanged)
+                if args.source_maps:
+                    atomic_streamed_file_process(
+                        in_path, out_path + '.map',
+                        lambda in_file, map_file: map_copy(in_file, map_file, in_path, out_path),
+                        readonly=args.readonly, keep_unchanged=args.keep_unchanged)
+            successes = [True] * len(pending)
+            ctx.verbose(f'Copied "{filename}"; it has no directives.')
+        if stats is not None:
+            stats.method = 'copied'
+    else:
+        index = None
+        if ctx.index_cache:
+            index = ctx.index_cache.get(input_record['hash'])
+            cached = index is not None
+            if not cached:
+                index = DirectiveIndex()
+        process_func = lambda in_file, out_files: preprocess_variants(ctx, in_file, out_files, variants, envs, index, stats)
+        write_paths = out_paths
+        if args.source_maps:
+            process_func = with_source_maps(
+                lambda in_file, out_files, source_maps: preprocess_variants(ctx, in_file, out_files, variants, envs, index, stats, source_maps),
+                in_path, out_paths, args.source_map_columns)
+            write_paths = out_paths + [out_path + '.map' for out_path in out_paths]
+        if stats is not None:
+            process_func = stats.timed(process_func)
+            if index is not None and cached:
+                stats.method = 'replayed'
+        successes = atomic_streamed_multi_file_process(in_path, write_paths, process_func, readonly=args.readonly, keep_unchanged=args.keep_unchanged)
+        if index is not None and not cached and index.complete:
+            ctx.index_cache.put(input_record['hash'], index)
+        if any(successes):
+            if index is not None and cached:
+                ctx.verbose(f'Preprocessed "{filename}" from its cached index.')
+            else:
+                ctx.verbose(f'Preprocessed "{filename}".')
+    if stats is not None:
+        stats.finish(time.perf_counter() - start, in_path, out_paths)
+        ctx.file_stats.append(stats)
+
+    for ((index, _, out_path), env, success) in zip(pending, envs, successes):
+        entries[index] = success and {
+            'jprep': jprep_id(),
+            'options': ctx.options_hash(),
+            'deps': env.observed,
+            'input': input_record,
+            'output': file_record(out_path),
+            } or None
+    return entries
+
+def record_entries(ctx, filename, entries):
+    for (variant, entry) in zip(ctx.variants, entries):
+        variant.manifest.update(filename, entry)
+
+# The context of the run a worker process is helping with; set once when the worker starts
+worker_ctx = None
+
+def init_worker(ctx):
+    global worker_ctx
+    worker_ctx = ctx
+
+def process_file_in_worker(filename):
+    """Runs process_file in a worker process, returning its exit code and log messages
+instead of logging them, so that they can be reported in order by the main process"""
+    worker_ctx.exit_code = 0
+    worker_ctx.messages = []
+    if worker_ctx.file_stats is not None:
+        worker_ctx.file_stats = []
+    entries = process_file(worker_ctx, filename)
+    return filename, worker_ctx.exit_code, worker_ctx.messages, entries, worker_ctx.file_stats, worker_ctx.take_profile()
+
+def process_file_in_thread(ctx, filename):
+    """Like process_file_in_worker, but for a thread in this process, which gets a copy of
+ctx of its own for the file"""
+    file_ctx = copy.copy(ctx)
+    file_ctx.exit_code = 0
+    file_ctx.messages = []
+    if ctx.file_stats is not None:
+        file_ctx.file_stats = []
+    entries = process_file(file_ctx, filename)
+    return filename, file_ctx.exit_code, file_ctx.messages, entries, file_ctx.file_stats, None
+
+def record_result(ctx, result):
+    """Logs and records what process_file_in_worker or process_file_in_thread returned"""
+    (filename, exit_code, messages, entries, file_stats, profile) = result
+    for level, message in messages:
+        ctx.log(level, message)
+    if exit_code:
+        ctx.exit_code = exit_code
+    record_entries(ctx, filename, entries)
+    if file_stats:
+        ctx.file_stats += file_stats
+    if profile:
+        ctx.worker_profiles.append(profile)
+
+def matches_any(path, patterns):
+    """True if path (relative to the input directory, with "/" between directories) matches
+any of the glob patterns; a pattern with no "/" only has to match the last part of path"""
+    from fnmatch import fnmatch
+    name = path.rpartition('/')[2]
+    return any(fnmatch(path if '/' in pattern else name, pattern) for pattern in patterns)
+
+def find_files(ctx, start='', walked=None):
+    """Yields the path, relative to the input directory, of each file in it or in any
+directory under it that matches --include and not --exclude, as they are found.
+Directories are walked in order of name, and a directory that matches --exclude is
+not walked at all. The output directories, the index cache, and the configuration
+files are always left out.
+Only the directory start (relative to the input directory) is walked, if it is given.
+If walked is given, the absolute path of each directory walked is added to it, and a
+directory under start that is already in it is not walked again, so that a directory
+can be checked for new files without walking everything under it."""
+    args = ctx.args
+    includes = args.include or DEFAULT_INCLUDE
+    excludes = args.exclude or []
+    skipped_dirs = {os.path.realpath(variant.out_dir) for variant in ctx.variants}
+    if args.index_cache:
+        skipped_dirs.add(os.path.realpath(args.index_cache))
+    skipped_files = {os.path.realpath(path) for path in ctx.config_paths()}
+    skipped_names = {os.path.basename(path) for path in skipped_files}
+
+    def walk(directory, prefix):
+        if walked is not None:
+            walked.add(os.path.abspath(directory))
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            ctx.error(e)
+            return
+        for entry in entries:
+            path = prefix + entry.name
+            if excludes and matches_any(path, excludes):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if walked is not None and os.path.abspath(entry.path) in walked:
+                    continue
+                if os.path.realpath(entry.path) not in skipped_dirs:
+                    yield from walk(entry.path, path + '/')
+            elif matches_any(path, includes):
+                if entry.name in skipped_names and os.path.realpath(entry.path) in skipped_files:
+                    continue
+                yield path
+
+    yield from walk(os.path.join(args.in_dir, start), start + '/' if start else '')
+
+def input_files(ctx, found):
+    """Yields the files named on the command line, and then, with --recursive, the
+other files that find_files finds, appending each of them to found as well"""
+    for filename in ctx.args.files:
+        found.append(filename)
+        yield filename
+    if ctx.args.recursive:
+        named = set(ctx.args.files)
+        for filename in find_files(ctx):
+            if filename not in named:
+                found.append(filename)
+                yield filename
+
+def process_files(ctx, filenames):
+    """Processes all the given files, spreading them over ctx.args.jobs processes,
+and records the results in the build manifest. filenames can be any iterable; each
+file is started on as soon as it comes out of it."""
+    jobs = ctx.args.jobs or os.cpu_count() or 1
+    if jobs <= 1 and getattr(ctx.args, 'io_threads', 1) > 1:
+        process_files_async(ctx, filenames)
+        return
+    # a list of files is split evenly between the workers, but files that are still
+    # being found are handed out a few at a time
+    chunksize = max(1, len(filenames) // (jobs * 4)) if isinstance(filenames, list) else 4
+    filenames = iter(filenames)
+    first = list(itertools.islice(filenames, 2))
+    filenames = itertools.chain(first, filenames)
+    if jobs <= 1 or len(first) <= 1:
+        for filename in filenames:
+            record_entries(ctx, filename, process_file(ctx, filename))
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    prepare_for_workers(ctx)
+    # the configuration is shipped to each worker once, rather than with every file
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(ctx,)) as pool:
+        for result in pool.map(process_file_in_worker, filenames, chunksize=chunksize):
+            record_result(ctx, result)
+
+def prepare_for_workers(ctx):
+    """Loads the manifests (and hashes the options) up front, so that each worker
+does not have to"""
+    if ctx.args.build_off:
+        for variant in ctx.variants:
+            variant.manifest.load()
+    ctx.options_hash()
+
+def process_files_async(ctx, filenames):
+    """Processes the given files on ctx.args.io_threads threads, driven by an asyncio event
+loop, so that the file system calls made for several files (including finding them, with
+--recursive) wait at the same time. The parsing itself is no faster, but time spent waiting
+on a slow file system is hidden. At most io_threads files are in flight at once, and their
+results are recorded in the order of filenames."""
+    import asyncio
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    threads = ctx.args.io_threads
+    prepare_for_workers(ctx)
+
+    async def drive(executor):
+        loop = asyncio.get_running_loop()
+        names = iter(filenames)
+        in_flight = deque()
+        while True:
+            # finding the next file may mean listing a directory, which is waited on in a thread too
+            filename = await loop.run_in_executor(executor, next, names, None)
+            if filename is None:
+                break
+            in_flight.append(loop.run_in_executor(executor, process_file_in_thread, ctx, filename))
+            if len(in_flight) >= threads:
+                record_result(ctx, await in_flight.popleft())
+        while in_flight:
+            record_result(ctx, await in_flight.popleft())
+
+    # one more thread than files in flight, for finding files
+    with ThreadPoolExecutor(max_workers=threads + 1) as executor:
+        asyncio.run(drive(executor))
+
+#--------------------------------------------------------------------------------------------------
+# Standard input and output
+
+def preprocess_stdio(ctx):
+    """Preprocesses standard input to standard output, under the configuration and definitions
+given on the command line. Returns whether it succeeded; if it did not, part of the output
+may already have been written."""
+    in_file = io.TextIOWrapper(sys.stdin.buffer, newline='')
+    out_file = io.TextIOWrapper(sys.stdout.buffer, newline='')
+    env = ParsingEnvironment.from_base_env(ctx.variants[0].global_env)
+    try:
+        return preprocess(ctx, in_file, out_file, env)
+    finally:
+        out_file.flush()
+
+def read_frame(in_file):
+    """Reads a frame (a 4 byte big-endian length, followed by that many bytes) from in_file,
+and returns its bytes, or None if in_file has ended"""
+    header = in_file.read(4)
+    if not header:
+        return None
+    length = int.from_bytes(header, 'big') if len(header) == 4 else -1
+    data = in_file.read(length) if length >= 0 else b''
+    if len(data) != length:
+        raise EOFError('Standard input ended in the middle of a frame')
+    return data
+
+def write_frame(out_file, data):
+    out_file.write(len(data).to_bytes(4, 'big'))
+    out_file.write(data)
+
+def serve_framed(ctx):
+    """Preprocesses each source framed on standard input under the configuration and
+definitions given on the command line, writing a status byte and a framed reply for
+each of them to standard output, until standard input ends"""
+    in_file = sys.stdin.buffer
+    out_file = sys.stdout.buffer
+    count = 0
+    while True:
+        try:
+            source = read_frame(in_file)
+        except EOFError as e:
+            ctx.error(e)
+            break
+        if source is None:
+            break
+        count += 1
+        out = io.StringIO()
+        env = ParsingEnvironment.from_base_env(ctx.variants[0].global_env)
+        try:
+            ctx.profiled(do_preprocess, io.StringIO(source.decode('utf-8')), out, env, ctx.args.strict_define)
+            (status, reply) = (0, out.getvalue())
+        except (PreprocessException, UnicodeDecodeError) as e:
+            ctx.verbose(f'Source {count} has an error.')
+            (status, reply) = (1, str(e))
+        out_file.write(bytes([status]))
+        write_frame(out_file, reply.encode('utf-8'))
+        out_file.flush()
+    ctx.verbose(f'Preprocessed {count} framed sources.')
+
+#--------------------------------------------------------------------------------------------------
+# Library interface
+
+class Preprocessor:
+    """Preprocesses JavaScript/TypeScript source in-process, without going through files
+named on the command line. The configuration is parsed once, when the Preprocessor
+is created, and is never modified after that, so one Preprocessor can be reused for
+any number of sources, including from several threads at once.
+config is the path of a configuration file, and config_string is the text of one;
+at most one of them should be given. strict has the same meaning as --strict_define.
+Errors in the configuration or in a source are raised as PreprocessException."""
+    def __init__(self, config=None, config_string=None, strict=False):
+        self.strict = strict
+        self.global_env = ParsingEnvironment()
+        if config is not None:
+            with open(config, 'r', newline='') as in_file:
+                do_preprocess(in_file, NullOut(), self.global_env, strict)
+        elif config_string is not None:
+            do_preprocess(io.StringIO(config_string), NullOut(), self.global_env, strict)
+        self.global_env.l = None
+
+    def process_stream(self, in_file, out_file):
+        """Preprocesses the text read from in_file, writing the result to out_file"""
+        do_preprocess(in_file, out_file, ParsingEnvironment.from_base_env(self.global_env), self.strict)
+
+    def process_string(self, source):
+        """Returns the result of preprocessing source"""
+        out_file = io.StringIO()
+        self.process_stream(io.StringIO(source), out_file)
+        return out_file.getvalue()
+
+    def process_file(self, in_path, out_path=None):
+        """Preprocesses the file at in_path. If out_path is given, the result is written
+there (atomically, so a failure leaves any existing file alone); otherwise it is returned."""
+        if out_path is None:
+            out_file = io.StringIO()
+            with open(in_path, 'r', newline='') as in_file:
+                self.process_stream(in_file, out_file)
+            return out_file.getvalue()
+        def process_func(in_file, out_file):
+            self.process_stream(in_file, out_file)
+            return True
+        atomic_streamed_file_process(in_path, out_path, process_func)
+
+#--------------------------------------------------------------------------------------------------
+# Watch mode
+
+class PollingWatcher:
+    """Watches a set of files for changes by periodically checking their size and modification time.
+Directories can be watched too, in which case a change to one (such as a file being created in
+it) reports the directory itself as changed."""
+    def __init__(self, paths, directories=(), interval=0.1):
+        self.interval = interval
+        self.stats = {path: self.stat(path) for path in itertools.chain(paths, directories)}
+
+    def add(self, path):
+        """Starts watching another file"""
+        self.stats.setdefault(path, self.stat(path))
+
+    def add_directory(self, directory):
+        """Starts watching another directory"""
+        self.add(directory)
+
+    @staticmethod
+    def stat(path):
+        try:
+            st = os.stat(path)
+            return (st.st_size, st.st_mtime_ns)
+        except OSError:
+            return None
+
+    def wait(self, timeout=None):
+        """Waits up to timeout seconds (forever if it is None) for any of the files to change,
+and returns the set of paths that did"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            changed = set()
+            for (path, old_stat) in self.stats.items():
+                new_stat = self.stat(path)
+                if new_stat != old_stat:
+                    self.stats[path] = new_stat
+                    changed.add(path)
+            if changed:
+                return changed
+            if deadline is None:
+                time.sleep(self.interval)
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return changed
+                time.sleep(min(self.interval, remaining))
+
+    def close(self):
+        pass
+
+class InotifyWatcher:
+    """Watches a set of files for changes using Linux's inotify, which wakes up as soon as
+a file is written instead of polling. The directories containing the files are watched,
+so that files which are replaced by renaming over them (as many editors do) are noticed.
+Directories can be watched too, in which case a file or directory being created in one
+(or moved into it) reports the directory itself as changed."""
+    # from <sys/inotify.h>
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    EVENT_HEADER_SIZE = 16
+
+    def __init__(self, paths, directories=()):
+        import ctypes, ctypes.util
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.paths = set(paths)
+        # the directories whose new entries are reported
+        self.listed = set(directories)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # watch descriptor -> directory, for every directory with an inotify watch
+        self.directories = {}
+        for directory in {os.path.dirname(path) for path in self.paths} | self.listed:
+            try:
+                self.watch_directory(directory)
+            except OSError:
+                os.close(self.fd)
+                raise
+
+    def watch_directory(self, directory):
+        mask = (self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM
+            | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE)
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd < 0:
+            raise OSError(self.ctypes.get_errno(), f'could not watch "{directory}"')
+        self.directories[wd] = directory
+
+    def add(self, path):
+        """Starts watching another file"""
+        self.paths.add(path)
+        directory = os.path.dirname(path)
+        if directory not in self.directories.values():
+            self.watch_directory(directory)
+
+    def add_directory(self, directory):
+        """Starts watching another directory"""
+        self.listed.add(directory)
+        if directory not in self.directories.values():
+            self.watch_directory(directory)
+
+    def read_events(self):
+        """Returns the set of watched paths named by all events that are waiting to be read"""
+        import struct
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                (wd, mask, cookie, length) = struct.unpack_from('iIII', data, offset)
+                offset += self.EVENT_HEADER_SIZE
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                directory = self.directories.get(wd, '')
+                path = os.path.join(directory, os.fsdecode(name))
+                if path in self.paths:
+                    changed.add(path)
+                elif mask & (self.IN_CREATE | self.IN_MOVED_TO) and directory in self.listed:
+                    changed.add(directory)
+
+    def wait(self, timeout=None):
+        """Waits up to timeout seconds (forever if it is None) for any of the files to change,
+and returns the set of paths that did"""
+        import select
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            ready, _, _ = select.select([self.fd], [], [], remaining)
+            changed = self.read_events() if ready else set()
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+    def close(self):
+        os.close(self.fd)
+
+def make_watcher(paths, directories=()):
+    """Watches paths and directories with inotify if it is available, or by polling otherwise"""
+    try:
+        return InotifyWatcher(paths, directories)
+    except (OSError, AttributeError, TypeError):
+        return PollingWatcher(paths, directories)
+
+def wait_for_changes(watcher, debounce):
+    """Blocks until something changes, then keeps collecting changes until there has been
+a pause of debounce seconds, so that a burst of writes is handled all at once"""
+    changed = watcher.wait()
+    while True:
+        more = watcher.wait(debounce)
+        if not more:
+            return changed
+        changed |= more
+
+def reload_config(ctx):
+    """Parses the configuration files again, keeping the old configuration if they have errors"""
+    if load_configurations(ctx):
+        for variant in ctx.variants:
+            ctx.verbose(show_global_env(variant))
+        return True
+    ctx.error('The configuration has errors; keeping the previous configuration.')
+    return False
+
+def watch(ctx):
+    """Preprocesses files again as they change, until interrupted.
+The configuration stays parsed in memory, and is only parsed again when a
+configuration file itself changes. After the first build, everything is
+incremental, so a change to the configuration only rebuilds the files that
+depend on what changed. With --recursive, the directories in the input directory
+are watched as well, and files that --recursive would find are picked up as they
+are created."""
+    args = ctx.args
+    args.build_off = True
+    watched = {
+        os.path.abspath(os.path.join(args.in_dir, filename)): filename
+        for filename in args.files
+        }
+    config_paths = {os.path.abspath(path) for path in ctx.config_paths()}
+    paths = set(watched) | config_paths
+    # with --recursive, the absolute paths of the directories find_files walks
+    directories = set()
+    if args.recursive:
+        for _ in find_files(ctx, walked=directories):
+            pass
+
+    watcher = make_watcher(paths, directories)
+    ctx.verbose(f'Watching {len(watched)} files for changes ({type(watcher).__name__}).')
+
+    def find_new_files(changed_directories):
+        """The files found in changed_directories (or in new directories in them) that are not
+watched yet; they and any new directories are watched from now on"""
+        new_files = []
+        for directory in sorted(changed_directories):
+            walked = set(directories)
+            start = os.path.relpath(directory, os.path.abspath(args.in_dir)).replace(os.sep, '/')
+            for filename in find_files(ctx, '' if start == '.' else start, walked):
+                path = os.path.abspath(os.path.join(args.in_dir, filename))
+                if path not in watched and path not in config_paths:
+                    watched[path] = filename
+                    args.files.append(filename)
+                    watcher.add(path)
+                    new_files.append(filename)
+            for new_directory in walked - directories:
+                directories.add(new_directory)
+                try:
+                    watcher.add_directory(new_directory)
+                except OSError:
+                    # it has already been removed again
+                    pass
+        return new_files
+
+    try:
+        while True:
+            changed = wait_for_changes(watcher, args.debounce / 1000)
+            ctx.exit_code = 0
+            new_files = find_new_files(changed & directories) if args.recursive else []
+            if (changed & config_paths) and reload_config(ctx):
+                # any file may depend on the configuration; the manifest knows which ones really do
+                filenames = list(args.files)
+            else:
+                filenames = [watched[path] for path in sorted(changed) if path in watched]
+                filenames += [filename for filename in new_files if filename not in filenames]
+            filenames = [
+                filename for filename in filenames
+                if os.path.exists(os.path.join(args.in_dir, filename))
+                ]
+            try:
+                process_files(ctx, filenames)
+            except OSError as e:
+                ctx.error(e)
+            ctx.finish_build()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+def main():
+    """Runs jprep from the command line"""
+    # Parse the arguments
+    ctx = RunContext(parseArguments())
+    args = ctx.args
+
+    # Verbose flag takes effect
+    if args.verbose:
+        set_log_level(LOG_VERBOSE_LEVEL_NUM)
+    ctx.verbose('Starting.')
+
+    # Create the output directories if they do not exist; any directories within them are
+    # created as files are written to them
+    piped = args.stdio or args.framed
+    if not piped:
+        for variant in ctx.variants:
+            ctx.make_dir(variant.out_dir)
+
+    # Read the configuration files and definitions if there are any
+    if ctx.config_paths() or args.defines or os.environ.get(DEFINES_ENV_VAR):
+        if load_configurations(ctx):
+            for variant in ctx.variants:
+                ctx.verbose(show_global_env(variant))
+        else:
+            # nothing is preprocessed without the configuration, so that existing outputs are left as they are
+            ctx.exit_code = ctx.exit_code or -1
+
+    # Sources piped through standard input and output are not part of any build
+    if piped:
+        if not ctx.exit_code:
+            if args.stdio:
+                preprocess_stdio(ctx)
+            else:
+                serve_framed(ctx)
+        if args.profile:
+            write_profile(ctx, args.profile)
+        exit(ctx.exit_code)
+
+    if ctx.exit_code:
+        exit(ctx.exit_code)
+
+    # files found by --recursive are processed as soon as they are found
+    found = []
+    process_files(ctx, input_files(ctx, found))
+    args.files = found
+    ctx.finish_build()
+
+    if args.watch:
+        watch(ctx)
+
+    exit(ctx.exit_code)
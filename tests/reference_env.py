@@ -0,0 +1,112 @@
+"""
+The implementation of ParsingEnvironment from before its operations were made constant time,
+kept only so that test_parsing_environment.py can check the current one against it.
+"""
+
+from jprep_core import DefinitionEntry, IfEntry, PreprocessException
+
+class ReferenceEnvironment:
+    """ParsingEnvironment as it was before it was made constant time: a stack of scopes,
+each a dict of definitions, which the base environment's scopes are copied into"""
+
+    def push_scope(self):
+        """Enter a new scope"""
+        self.scopes.append({})
+
+    def pop_scope(self, ends_branch=False):
+        """Leave the current scope"""
+        if ((not ends_branch
+            and self.in_if()
+            and len(self.scopes) <= self.get_if_starting_scope_depth())
+        or len(self.scopes) <= self.base_depth):
+            raise PreprocessException('Attempted to leave final scope.', self.l)
+        self.scopes.pop()
+
+    def define(self, name, value=None, choices=None):
+        """Adds or overwrites the definition of name in the current scope"""
+        self.scopes[-1][name] = DefinitionEntry(value, choices)
+
+    def undefine(self, name):
+        """Removes a definition of name from the current scope"""
+        if name not in self.scopes[-1]:
+            raise PreprocessException(f'Cannot undefine "{name}"; it does not exist in the current scope.', self.l)
+        del self.scopes[-1][name]
+
+    def lookup(self, name):
+        """Gets the entry for the most deeply nested definition of name, if there are any.
+If the result came from the base environment (or there was none), it is recorded in observed."""
+        for depth in range(len(self.scopes) - 1, -1, -1):
+            scope = self.scopes[depth]
+            if name in scope:
+                entry = scope[name]
+                if depth < self.base_depth - 1:
+                    self.observed[name] = [entry.value, entry.choices]
+                return entry
+        self.observed[name] = None
+        return None
+
+    def get_scope_depth(self):
+        return len(self.scopes)
+
+    def get_if_depth(self):
+        return len(self.if_stack)
+
+    def push_if(self):
+        """Enter a new if directive"""
+        self.if_stack.append(IfEntry(len(self.scopes)))
+
+    def pop_if(self):
+        """Leave the current if directive"""
+        self.if_stack.pop()
+
+    def in_if(self):
+        return bool(self.if_stack)
+
+    def set_if_branch(self, flag):
+        """Set the current if directive's truthfulness"""
+        self.if_stack[-1].in_true = flag
+        self.if_stack[-1].seen_true |= flag
+
+    def set_if_state(self, state):
+        self.if_stack[-1].state = state
+
+    def get_if_state(self):
+        return self.if_stack[-1].state
+
+    def get_seen_true(self):
+        return self.if_stack[-1].seen_true
+
+    def get_in_true(self):
+        for entry in self.if_stack:
+            if not entry.in_true:
+                return False
+        return True
+
+    def get_if_starting_scope_depth(self):
+        return self.if_stack[-1].scope_depth
+
+    def __init__(self):
+        self.scopes = []
+        self.if_stack = []
+        self.push_scope()
+        # scopes at or below this depth can never be left
+        self.base_depth = 1
+        # everything that was looked up in the base environment, and what was seen
+        # (as [value, choices], or None if it was not defined)
+        self.observed = {}
+        self.l = None
+
+    @classmethod
+    def from_base_env(cls, env):
+        """Creates an environment which can see all definitions in env, and has a new
+scope of its own on top of them, so that nothing it defines or undefines leaks into env"""
+        result = cls()
+        result.scopes = env.scopes + result.scopes
+        result.base_depth = len(result.scopes)
+        return result
+
+    def __getstate__(self):
+        # the parser's local variables are only meaningful during a parse
+        state = self.__dict__.copy()
+        state['l'] = None
+        return state
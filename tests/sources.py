@@ -0,0 +1,97 @@
+"""
+Generates random sources and configurations for the randomised tests. The sources mix
+code, strings, comments, template literals, braces and directives (some of them malformed),
+so that they exercise both the output and the errors of the preprocessor.
+"""
+
+import io
+import random
+
+from jprep_core import ParsingEnvironment, PreprocessException, do_preprocess, NullOut
+
+NAMES = ['a', 'b', 'mode', 'x']
+VALUES = ['on', 'off', 'debug', 'release']
+
+def whitespace(r):
+    return r.choice(['', ' ', '  ', '', ' ', '\n', ' \n', '\t'])
+
+def directive(r):
+    """A directive other than an if, or None"""
+    k = r.random()
+    name = r.choice(NAMES)
+    if k < 0.15:
+        return f'/*${whitespace(r)}note{whitespace(r)} hi {r.choice(["", "x", "/* y"])}*/'
+    if k < 0.3:
+        value = f'= {r.choice(VALUES)}{whitespace(r)}' if r.random() < 0.7 else ''
+        return f'/*${whitespace(r)}define {name}{whitespace(r)}{value}*/'
+    if k < 0.35:
+        return f'/*$ define {name} *//*$ undefine {name} */'
+    return None
+
+def condition(r):
+    name = r.choice(NAMES)
+    return name + (f' = {r.choice(VALUES)}' if r.random() < 0.7 else '')
+
+def code(r, depth, budget):
+    """Random source text, of about budget[0] pieces, nested depth deep"""
+    out = []
+    while budget[0] > 0:
+        budget[0] -= 1
+        k = r.random()
+        if k < 0.12:
+            out.append(r.choice(['let q = 1;', 'foo(bar)', '   ', 'x', 'ü', '\t']))
+        elif k < 0.22:
+            out.append('\n')
+        elif k < 0.27:
+            out.append(r.choice(['"s /*$note*/ t"', "'q\\' /*$x*/'", '"a\\\nb"', '""', "'{'"]))
+        elif k < 0.31:
+            out.append(r.choice(['// c /*$note*/ {\n', '/* b { /*$note x*/\n */', '/**/']))
+        elif k < 0.36 and depth < 2:
+            out.append('`t ${' + code(r, depth + 1, [2]) + '} u`')
+        elif k < 0.40:
+            out.append('`plain \\` /*$note*/ ${1}`')
+        elif k < 0.50 and depth < 5:
+            out.append('{' + code(r, depth + 1, [r.randint(0, 6)]) + '}')
+        elif k < 0.62 and depth < 5:
+            text = f'/*${whitespace(r)}if {condition(r)}{whitespace(r)}*/' + code(r, depth + 1, [r.randint(0, 6)])
+            for _ in range(r.randint(0, 2)):
+                text += f'/*$ elseif {r.choice(NAMES)} = {r.choice(VALUES)} */' + code(r, depth + 1, [r.randint(0, 5)])
+            if r.random() < 0.5:
+                text += '/*$else*/' + code(r, depth + 1, [r.randint(0, 5)])
+            text += f'/*${whitespace(r)}fi{whitespace(r)}*/'
+            out.append(text)
+        else:
+            text = directive(r)
+            if text:
+                out.append(text)
+    return ''.join(out)
+
+def source(seed, size=40):
+    """A random source file"""
+    r = random.Random(seed)
+    text = code(r, 0, [size])
+    if r.random() < 0.1:
+        text += '}'
+    return text + '\n'
+
+def config(seed):
+    """A random configuration, defining some of NAMES"""
+    r = random.Random(seed * 7 + 1)
+    lines = [f'/*$ define {name} = {r.choice(VALUES)} */' for name in NAMES if r.random() < 0.6]
+    return '\n'.join(lines) + '\n'
+
+def config_env(text, strict=False):
+    """The environment that the configuration text leaves"""
+    env = ParsingEnvironment()
+    do_preprocess(io.StringIO(text), NullOut(), env, strict)
+    env.l = None
+    return env
+
+def outcome(out_file, error):
+    """What a target of do_preprocess_many came to: its output, or the message of its error.
+The text of the line an error is reported on is left out, since it depends on how the line
+was read (a line split into pieces only shows the piece the error is in)."""
+    if error is None:
+        return ('ok', out_file.getvalue())
+    assert isinstance(error, PreprocessException)
+    return ('error', error.message, error.line_num)
@@ -0,0 +1,56 @@
+"""
+Tests of jprep.py run from the command line.
+"""
+
+import os
+import subprocess
+import sys
+
+JPREP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'jprep.py')
+
+def run_jprep(*args, cwd, input=None):
+    """Runs jprep.py with args in cwd, and returns the completed process"""
+    return subprocess.run(
+        [sys.executable, JPREP] + list(args),
+        cwd=cwd, input=input, capture_output=True, text=True)
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', newline='') as f:
+        f.write(text)
+
+def read(path):
+    with open(path, 'r', newline='') as f:
+        return f.read()
+
+def test_bad_define_leaves_outputs_alone(tmp_path):
+    write(tmp_path / 'in' / 'a.ts', '/*$if P = web*/web/*$else*/other/*$fi*/\n')
+    write(tmp_path / 'cfg.js', '/*$define P = web < web, node*/\n')
+    result = run_jprep('-i', 'in', '-o', 'out', '-c', 'cfg.js', 'a.ts', cwd=tmp_path)
+    assert result.returncode == 0, result.stderr
+    assert read(tmp_path / 'out' / 'a.ts') == 'web\n'
+
+    # a -D that is not one of the choices is an error, and nothing is built without it
+    result = run_jprep('-i', 'in', '-o', 'out', '-c', 'cfg.js', '-D', 'P=nod', '-f', 'a.ts', cwd=tmp_path)
+    assert result.returncode != 0
+    assert 'is not one of the required choices' in result.stderr
+    assert read(tmp_path / 'out' / 'a.ts') == 'web\n'
+
+def test_stdio_writes_nothing(tmp_path):
+    write(tmp_path / 'cfg.js', '/*$define P = web*/\n')
+    # the default output directory, as an earlier build would have left it
+    os.mkdir(tmp_path / 'preprocessed')
+    result = run_jprep('-c', 'cfg.js', '--stdio', cwd=tmp_path, input='/*$if P = web*/web/*$fi*/\n')
+    assert result.returncode == 0, result.stderr
+    assert result.stdout == 'web\n'
+    assert os.listdir(tmp_path / 'preprocessed') == []
+
+def test_import():
+    import logging
+    import jprep
+    import jprep_core
+    # jprep stays a module of its own, with everything in jprep_core
+    assert jprep is not jprep_core
+    assert jprep.__name__ == 'jprep'
+    assert isinstance(jprep.log, logging.Logger)
+    assert jprep.Preprocessor(config_string='/*$define P*/').process_string('/*$if P*/a/*$fi*/') == 'a'
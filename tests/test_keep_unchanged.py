@@ -0,0 +1,78 @@
+"""
+Tests of atomic_streamed_file_process with keep_unchanged, which leaves an output that
+would not change untouched.
+"""
+
+import os
+import random
+
+import pytest
+
+from jprep_core import atomic_streamed_file_process
+
+TEXTS = ['', 'a', 'let x = 1;\n', 'ü€ 𝄞\r\nline two\r\n', 'x' * 5000 + '\n']
+
+def variants(r, text):
+    """Outputs that differ from text in the ways an output can change"""
+    yield text
+    yield text[:r.randrange(len(text) + 1)]
+    yield text + r.choice(['\n', 'é', 'more;'])
+    if text:
+        i = r.randrange(len(text))
+        yield text[:i] + r.choice(['?', 'ß', '\n']) + text[i + 1:]
+
+def writer(r, text, success=True):
+    """A process_func which writes text in pieces of random size"""
+    def process(in_file, out_file):
+        i = 0
+        while i < len(text):
+            n = r.randint(1, 7)
+            out_file.write(text[i:i + n])
+            i += n
+        return success
+    return process
+
+def setup(tmp_path, old):
+    in_path = str(tmp_path / 'in.js')
+    out_path = str(tmp_path / 'out.js')
+    with open(in_path, 'w', encoding='utf-8') as f:
+        f.write('')
+    if old is not None:
+        with open(out_path, 'w', encoding='utf-8', newline='') as f:
+            f.write(old)
+        # an old time, so that a rewrite would be noticed
+        os.utime(out_path, ns=(1, 1))
+    return (in_path, out_path)
+
+def read(path):
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        return f.read()
+
+@pytest.mark.parametrize('seed', range(len(TEXTS)))
+def test_keep_unchanged(tmp_path, seed):
+    r = random.Random(seed)
+    new = TEXTS[seed]
+    for old in [None] + [old for text in TEXTS for old in variants(r, text)]:
+        (in_path, out_path) = setup(tmp_path, old)
+        assert atomic_streamed_file_process(in_path, out_path, writer(r, new), keep_unchanged=True)
+        assert read(out_path) == new
+        assert (os.stat(out_path).st_mtime_ns == 1) == (old == new)
+        assert not os.path.exists(out_path + '.temp')
+
+def test_failure_leaves_output(tmp_path):
+    r = random.Random(0)
+    (in_path, out_path) = setup(tmp_path, 'old\n')
+    assert not atomic_streamed_file_process(in_path, out_path, writer(r, 'new\n', success=False), keep_unchanged=True)
+    assert read(out_path) == 'old\n'
+    assert os.stat(out_path).st_mtime_ns == 1
+    assert not os.path.exists(out_path + '.temp')
+
+def test_exception_leaves_output(tmp_path):
+    (in_path, out_path) = setup(tmp_path, 'old\n')
+    def process(in_file, out_file):
+        out_file.write('new')
+        raise ValueError()
+    with pytest.raises(ValueError):
+        atomic_streamed_file_process(in_path, out_path, process, keep_unchanged=True)
+    assert read(out_path) == 'old\n'
+    assert not os.path.exists(out_path + '.temp')
@@ -0,0 +1,134 @@
+"""
+Checks ParsingEnvironment against the implementation it replaced, in reference_env.py, by
+running the same random operations on both.
+"""
+
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from jprep_core import ParsingEnvironment, PreprocessException
+from reference_env import ReferenceEnvironment
+
+NAMES = ['a', 'b', 'c', 'mode']
+VALUES = [None, 'on', 'off', 'debug']
+CHOICES = [None, ['on', 'off'], ['debug', 'release', 'on']]
+
+def location():
+    """Stands in for the parser's local variables, which PreprocessException reads the location from"""
+    return SimpleNamespace(scan=1, line_num=1, in_line='')
+
+def entry_state(entry):
+    return entry and (entry.value, entry.choices)
+
+def attempt(env, op, *args):
+    """Runs op on env, and returns what it returned or the message of the error it raised"""
+    try:
+        return ('ok', getattr(env, op)(*args))
+    except PreprocessException as e:
+        return ('error', e.message)
+
+def random_op(r, ref):
+    """Picks an operation which the parser could make on an environment in ref's state"""
+    ops = ['push_scope', 'pop_scope', 'define', 'define', 'undefine', 'lookup', 'lookup', 'evaluate', 'push_if']
+    if ref.in_if():
+        ops += ['pop_if', 'set_if_branch', 'set_if_branch', 'pop_scope_branch']
+    op = r.choice(ops)
+    if op == 'define':
+        return (op, r.choice(NAMES), r.choice(VALUES), r.choice(CHOICES))
+    if op in ('undefine', 'lookup'):
+        return (op, r.choice(NAMES))
+    if op == 'evaluate':
+        return (op, r.choice(NAMES), r.choice(VALUES))
+    if op == 'set_if_branch':
+        return (op, r.random() < 0.5)
+    if op == 'pop_scope_branch':
+        return ('pop_scope', True)
+    return (op,)
+
+def apply(env, op, args):
+    if op == 'lookup':
+        (ok, entry) = attempt(env, op, *args)
+        return (ok, entry_state(entry))
+    return attempt(env, op, *args)
+
+def evaluate_reference(ref, name, value):
+    """What ParsingEnvironment.evaluate should give, worked out from ref directly"""
+    entry = ref.lookup(name)
+    if entry is None:
+        return None
+    return (entry_state(entry), entry.choices is None or value in entry.choices, entry.value == value)
+
+def state(env):
+    return (
+        env.get_scope_depth(),
+        env.get_if_depth(),
+        env.get_in_true(),
+        env.in_if() and (env.get_seen_true(), env.get_if_starting_scope_depth()),
+        env.observed,
+    )
+
+def check_same(r, env, ref, steps):
+    env.l = ref.l = location()
+    for _ in range(steps):
+        (op, *args) = random_op(r, ref)
+        if op == 'evaluate':
+            result = env.evaluate(*args)
+            if result is not None:
+                result = (entry_state(result[0]),) + result[1:]
+            assert result == evaluate_reference(ref, *args), (op, args)
+        else:
+            assert apply(env, op, args) == apply(ref, op, args), (op, args)
+        assert state(env) == state(ref), (op, args)
+        # the base environment's scopes are not part of the snapshot
+        scopes = [[[name, entry.value, entry.choices] for (name, entry) in scope.items()]
+            for scope in ref.scopes[env.base_scope_depth:]]
+        assert env.snapshot() == scopes, (op, args)
+    for name in NAMES:
+        assert entry_state(env.find(name)) == entry_state(ref.lookup(name))
+
+def build_base(r):
+    """A pair of matching environments with a few scopes of definitions, as a configuration leaves them"""
+    env = ParsingEnvironment()
+    ref = ReferenceEnvironment()
+    env.l = ref.l = location()
+    for _ in range(r.randrange(3)):
+        for _ in range(r.randrange(4)):
+            args = (r.choice(NAMES), r.choice(VALUES), r.choice(CHOICES))
+            env.define(*args)
+            ref.define(*args)
+        env.push_scope()
+        ref.push_scope()
+    return (env, ref)
+
+@pytest.mark.parametrize('seed', range(200))
+def test_matches_reference(seed):
+    r = random.Random(seed)
+    check_same(r, ParsingEnvironment(), ReferenceEnvironment(), 60)
+
+@pytest.mark.parametrize('seed', range(200))
+def test_matches_reference_on_base_env(seed):
+    r = random.Random(seed)
+    (base, base_ref) = build_base(r)
+    env = ParsingEnvironment.from_base_env(base)
+    ref = ReferenceEnvironment.from_base_env(base_ref)
+    check_same(r, env, ref, 60)
+    # nothing done on top of the base environment changes it
+    assert base.snapshot() == [[[name, entry.value, entry.choices] for (name, entry) in scope.items()]
+        for scope in base_ref.scopes]
+
+def test_evaluate_sees_changes():
+    env = ParsingEnvironment()
+    env.l = location()
+    env.define('mode', 'debug', ['debug', 'release'])
+    (entry, in_choices, result) = env.evaluate('mode', 'debug')
+    assert (in_choices, result) == (True, True)
+    env.push_scope()
+    env.define('mode', 'release', ['debug', 'release'])
+    assert env.evaluate('mode', 'debug')[1:] == (True, False)
+    assert env.evaluate('mode', 'other')[1:] == (False, False)
+    env.pop_scope()
+    assert env.evaluate('mode', 'debug')[1:] == (True, True)
+    env.undefine('mode')
+    assert env.evaluate('mode', 'debug') is None
@@ -0,0 +1,156 @@
+"""
+Tests of do_preprocess_many: a few examples, and randomised checks that the ways it can
+preprocess a file (one target at a time or many, scanning or replaying an index) all agree.
+"""
+
+import io
+import json
+import random
+
+import pytest
+
+import sources
+from jprep_core import DirectiveIndex, FileStats, ParsingEnvironment, Preprocessor, TimedFile, do_preprocess_many
+
+CONFIG = '/*$define A = on*/\n'
+
+@pytest.mark.parametrize('source, expected', [
+    # lines that only held directives, or that were skipped, are dropped
+    ('a\n/*$if A = off*/\nb\n/*$fi*/\nc\n', 'a\nc\n'),
+    ('  /*$note x*/  \nx /*$if A = off*/ y /*$else*/ z /*$fi*/ w\n', 'x  z  w\n'),
+    ('/*$if A = on*/\n  kept\n/*$fi*/\n', '  kept\n'),
+    ('a /*$if A = off*/\n\n/*$fi*/ b\r\n', 'a \n\n b\r\n'),
+    ('{ /*$define A = off*/ /*$if A = off*/x/*$fi*/ }\n/*$if A = on*/y/*$fi*/\n', '{  x }\ny\n'),
+    ('"/*$if A = off*/" // /*$if A = off*/\n', '"/*$if A = off*/" // /*$if A = off*/\n'),
+])
+def test_examples(source, expected):
+    assert Preprocessor(config_string=CONFIG).process_string(source) == expected
+
+def preprocess(source, envs, strict=False, **options):
+    """The outcome of preprocessing source from each of envs at once"""
+    outs = [io.StringIO() for _ in envs]
+    targets = [(out, ParsingEnvironment.from_base_env(env)) for (out, env) in zip(outs, envs)]
+    errors = do_preprocess_many(io.StringIO(source), targets, strict, **options)
+    return [sources.outcome(out, error) for (out, error) in zip(outs, errors)]
+
+def cases(count):
+    """Random sources, each with the environments of a few configurations"""
+    for seed in range(count):
+        strict = seed % 5 == 0
+        envs = [sources.config_env(sources.config(seed + k * 1000), strict) for k in range(4)]
+        yield (seed, sources.source(seed, 1 + seed % 30), envs, strict)
+
+def test_targets_match_single_runs():
+    for (seed, source, envs, strict) in cases(120):
+        singles = [preprocess(source, [env], strict)[0] for env in envs]
+        assert preprocess(source, envs, strict) == singles, seed
+
+def crlf(outcome):
+    return (outcome[0], outcome[1].replace('\n', '\r\n')) if outcome[0] == 'ok' else outcome
+
+def test_read_in_pieces():
+    """Line endings are kept as they are, and reading the input in pieces of any size
+(splitting long lines) makes no difference"""
+    for (seed, source, envs, strict) in cases(120):
+        if seed % 7 == 0:
+            source = source.rstrip('\n')
+        expected = preprocess(source, envs, strict)
+        if seed % 2:
+            source = source.replace('\n', '\r\n')
+            expected = [crlf(outcome) for outcome in expected]
+        buffer_size = [1, 3, 7, 64][seed % 4]
+        assert preprocess(source, envs, strict) == expected, seed
+        index = DirectiveIndex()
+        assert preprocess(source, envs, strict, index=index, buffer_size=buffer_size) == expected, seed
+        if index.complete:
+            assert preprocess(source, envs, strict, index=DirectiveIndex(index.ops), buffer_size=buffer_size) == expected, seed
+
+def test_token_index():
+    for (seed, source, envs, strict) in cases(120):
+        if seed % 3 == 0:
+            source = source.replace('\n', '\r\n')
+        if seed % 7 == 0:
+            source = source.replace('a', 'é')
+        buffer_size = [None, 7, 64, 1][seed % 4]
+        expected = preprocess(source, envs, strict, buffer_size=buffer_size)
+        assert preprocess(source, envs, strict, buffer_size=buffer_size, _token_index=True) == expected, seed
+
+def test_replayed_error_line_under_stats():
+    source = 'a\n/*$if Z = c*/\nb\n/*$fi*/\n'
+    envs = [sources.config_env(''), sources.config_env('/*$define Z = a < a, b*/')]
+    index = DirectiveIndex()
+    assert preprocess(source, envs, index=index)[0] == ('ok', 'a\n')
+    assert index.complete
+    stats = FileStats('in.js')
+    in_file = TimedFile(io.StringIO(source), stats)
+    targets = [(io.StringIO(), ParsingEnvironment.from_base_env(envs[1]))]
+    [error] = do_preprocess_many(in_file, targets, index=DirectiveIndex(index.ops), stats=stats)
+    assert (error.line_num, error.line) == (2, '/*$if Z = c*/\n')
+    assert in_file.lines() == 4
+
+def test_stats_depths():
+    for (source, scope_depth, if_depth) in [
+        # no directives at all
+        ('a { b { c { d } } }\n{ }\n', 3, 0),
+        ('{ /*$if A = on*/ { } /*$fi*/ }\n', 3, 1),
+        ('/*$if A = on*//*$if A = off*/x/*$fi*//*$fi*/\n', 2, 2),
+    ]:
+        stats = FileStats('in.js')
+        [outcome] = preprocess(source, [sources.config_env(CONFIG)], stats=stats)
+        assert outcome[0] == 'ok'
+        assert (stats.max_scope_depth, stats.max_if_depth) == (scope_depth, if_depth), source
+
+def test_replay_matches_scan():
+    replayed = 0
+    for (seed, source, envs, strict) in cases(120):
+        index = DirectiveIndex()
+        scanned = preprocess(source, envs[:2], strict, index=index)
+        assert scanned == [preprocess(source, [env], strict)[0] for env in envs[:2]], seed
+        if not index.complete:
+            continue
+        replayed += 1
+        # indexes are cached as JSON
+        ops = json.loads(json.dumps(index.ops))
+        for chosen in ([envs[2]], envs[1:], [envs[0]]):
+            assert preprocess(source, chosen, strict, index=DirectiveIndex(ops)) == preprocess(source, chosen, strict), seed
+    assert replayed > 40
+
+TOKENS = [
+    '{', '}', '{', '}', '"s"', "'q{'", '"\\\n"', '`a`', '`a ${', '`x\n', '${', '}`', '`', '/* c', '*/',
+    '/* { */', '// }', '\n', '\n', '\n', ' ', 'x', '/*$note n*/', '/*$define a = v*/', '/*$if b*/',
+    '/*$fi*/', '/*$else*/', '\\`']
+
+def test_dead_code():
+    """A branch is scanned the same way whether it is skipped or not"""
+    dead = sources.config_env('/*$define a = yy*/')
+    live = sources.config_env('/*$define a = zz*/')
+    for seed in range(500):
+        r = random.Random(seed)
+        body = ''.join(r.choice(TOKENS) for _ in range(r.randint(0, 25)))
+        source = f'a\n/*$if a = zz*/{body}/*$else*/live\n/*$fi*/\nend\n'
+        indexes = [DirectiveIndex(), DirectiveIndex()]
+        outcomes = [preprocess(source, [env], index=index)[0] for (env, index) in zip([dead, live], indexes)]
+        assert preprocess(source, [dead, live]) == outcomes, seed
+        # the index does not depend on the configuration
+        if all(index.complete for index in indexes):
+            assert indexes[0].ops == indexes[1].ops, seed
+
+def evaluate_uncached(env, name, value):
+    """ParsingEnvironment.evaluate without its cache"""
+    entry = env.lookup(name)
+    if entry is None:
+        return None
+    return (entry, entry.choices is None or value in entry.choices, entry.value == value)
+
+CHOICES_CONFIG = '/*$define mode = debug < debug, release*/\n/*$define x = on < on, off*/\n'
+
+def test_condition_cache(monkeypatch):
+    def outcomes():
+        for (seed, source, envs, strict) in cases(100):
+            # some of the names can only take some of the values
+            envs.append(sources.config_env(CHOICES_CONFIG, strict))
+            # the same conditions again, once they are cached
+            yield preprocess(source + source, envs, strict)
+    cached = list(outcomes())
+    monkeypatch.setattr(ParsingEnvironment, 'evaluate', evaluate_uncached)
+    assert list(outcomes()) == cached
@@ -0,0 +1,106 @@
+"""
+Checks the source maps built while preprocessing random sources, by decoding them and
+comparing every mapped position of the output with the source text.
+"""
+
+import io
+import json
+
+import pytest
+
+import sources
+from jprep_core import (
+    BASE64_DIGITS, DirectiveIndex, ParsingEnvironment, SourceMap, do_preprocess_many, map_copy, token_re)
+
+def decode(mappings):
+    """The segments of each line of a map, as (output column, source line, source column)"""
+    lines = []
+    line = column = 0
+    for text in mappings.split(';'):
+        segments = []
+        out_column = 0
+        for segment in filter(None, text.split(',')):
+            fields = []
+            value = shift = 0
+            for char in segment:
+                digit = BASE64_DIGITS.index(char)
+                value |= (digit & 31) << shift
+                shift += 5
+                if not digit & 32:
+                    fields.append(-(value >> 1) if value & 1 else value >> 1)
+                    value = shift = 0
+            assert len(fields) == 4 and fields[1] == 0
+            out_column += fields[0]
+            line += fields[2]
+            column += fields[3]
+            segments.append((out_column, line, column))
+        lines.append(segments)
+    return lines
+
+def check_map(source, output, map_text, columns):
+    """Checks that each position mapped in map_text holds the same text in output and source.
+Without columns, every line of output with anything in it must be mapped at its first token,
+and only the first character of it is checked, since the rest of the line may have come from
+elsewhere. With columns, each token must match up to where the next mapping starts."""
+    source_map = json.loads(map_text)
+    assert source_map['version'] == 3
+    assert source_map['file'] == 'out.js'
+    assert source_map['sources'] == ['in.js']
+    source_lines = source.split('\n')
+    output_lines = output.split('\n')
+    lines = decode(source_map['mappings'])
+    assert len(lines) <= len(output_lines)
+    for (out_line, segments) in zip(output_lines, lines):
+        if not columns:
+            assert len(segments) == (1 if out_line.strip() else 0), out_line
+        ends = [out_column for (out_column, _, _) in segments[1:]] + [len(out_line)]
+        for ((out_column, line, column), end) in zip(segments, ends):
+            token = token_re.match(out_line, out_column, end)
+            assert token, (out_line, out_column)
+            text = token.group() if columns else token.group()[0]
+            assert source_lines[line].startswith(text, column), (out_line, source_lines[line])
+    for out_line in output_lines[len(lines):]:
+        assert not out_line.strip()
+
+def preprocess(source, envs, columns, index=None, buffer_size=None):
+    """The outcome and map text of each of envs"""
+    outs = [io.StringIO() for _ in envs]
+    map_files = [io.StringIO() for _ in envs]
+    source_maps = [SourceMap(map_file, 'in.js', 'out.js', columns) for map_file in map_files]
+    errors = do_preprocess_many(
+        io.StringIO(source), [(out, ParsingEnvironment.from_base_env(env)) for (out, env) in zip(outs, envs)],
+        index=index, source_maps=source_maps, buffer_size=buffer_size)
+    for source_map in source_maps:
+        source_map.finish()
+    # the map of an output that failed is never written
+    return [
+        (sources.outcome(out, error), error is None and map_file.getvalue())
+        for (out, map_file, error) in zip(outs, map_files, errors)
+        ]
+
+@pytest.mark.parametrize('columns', [False, True])
+def test_source_maps(columns):
+    checked = 0
+    for seed in range(150):
+        source = sources.source(seed, 1 + seed % 30)
+        if seed % 3 == 0:
+            source = source.replace('\n', '\r\n')
+        envs = [sources.config_env(sources.config(seed + k * 1000)) for k in range(2)]
+        index = DirectiveIndex()
+        scanned = preprocess(source, envs, columns, index)
+        for (outcome, map_text) in scanned:
+            if outcome[0] == 'ok':
+                check_map(source, outcome[1], map_text, columns)
+                checked += 1
+        # replaying the index, or reading the source in small pieces, maps it the same way
+        if index.complete:
+            assert preprocess(source, envs, columns, DirectiveIndex(index.ops)) == scanned
+        assert preprocess(source, envs, columns, buffer_size=16) == scanned
+    assert checked > 100
+
+def test_map_copy_counts_only_newlines():
+    source = 'a\rb\nc\r\n  d\n'
+    map_file = io.StringIO()
+    assert map_copy(io.StringIO(source), map_file, 'in.js', 'out.js')
+    check_map(source, source, map_file.getvalue(), False)
+    assert decode(json.loads(map_file.getvalue())['mappings'])[:3] == [[(0, 0, 0)], [(0, 1, 0)], [(2, 2, 2)]]